@@ -0,0 +1,238 @@
+"""
+Offline throughput and latency benchmark of EhBot.
+
+Runs a synthetic stream of updates (mentions, /tag, /tldr, /deletetag and
+ordinary chatter across many chats) through the poll path
+(process_updates) and through the webhook handler. Replies go to a local
+stand-in for the Bot API and the data is kept by a TextFileMapper in a
+temporary directory, or by a LogStructuredMapper with --storage log.
+Reports throughput, p50/p99 latency per update and storage and HTTP
+calls per update. --noise sets the share of ordinary chatter, --noise 1
+measures the cost of updates the bot ignores.
+
+    python bench/bench_bot.py [--updates N] [--chats N] [--batch N] [--seed N]
+                              [--storage text|log] [--noise SHARE]
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, BOT_DIR)
+
+# share of each kind of message in the generated stream
+MIX = [
+    ("noise", 0.60),
+    ("mention", 0.15),
+    ("tag", 0.10),
+    ("tldr", 0.10),
+    ("deletetag", 0.05),
+]
+TEXTS = {
+    "noise": "just chatting about something else %s",
+    "mention": "hey @EhBot dinner at 8:30pm %s",
+    "tag": "/tag meeting notes %s",
+    "tldr": "/tldr",
+    "deletetag": "/deletetag 1",
+}
+USERS_PER_CHAT = 20
+START_DATE = 1440000000
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+class FakeBotApi(object):
+    """
+    Answers every Bot API method with success and counts the calls
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.app = bottle.Bottle()
+        self.app.route("/<token>/<method>", method=["GET", "POST"], callback=self.handle)
+
+    def start(self):
+        self.server = make_server("127.0.0.1", 0, self.app, server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return "http://127.0.0.1:%s/botBENCH" % self.server.server_port
+
+    def handle(self, token, method):
+        with self._lock:
+            self.calls[method] += 1
+        bottle.response.content_type = "application/json"
+        result = [] if method == "getUpdates" else {}
+        return json.dumps({"ok": True, "result": result})
+
+    def total(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+class CountingMapper(object):
+    """
+    Proxy that counts the calls made to the storage mapper
+    """
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.mapper, name)
+        if name.startswith("_") or name == "transaction" or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+    def total(self):
+        return sum(self.calls.values())
+
+def generate_updates(count, chats, seed, noise=None):
+    rng = random.Random(seed)
+    mix = MIX
+    if noise is not None:
+        # the other kinds keep their proportions among themselves
+        others = sum(share for kind, share in MIX if kind != "noise")
+        mix = [(kind, noise if kind == "noise" else share * (1 - noise) / others) for kind, share in MIX]
+    kinds = [kind for kind, share in mix for _ in range(int(round(share * 100)))]
+    for i in range(count):
+        chat = rng.randrange(chats)
+        user_id = chat * USERS_PER_CHAT + rng.randrange(USERS_PER_CHAT) + 1
+        kind = rng.choice(kinds)
+        text = TEXTS[kind] % i if "%s" in TEXTS[kind] else TEXTS[kind]
+        yield {
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "from": {"id": user_id, "first_name": "User%s" % user_id, "username": "user%s" % user_id},
+                "chat": {"id": -(1000000 + chat), "type": "group"},
+                "date": START_DATE + i,
+                "text": text,
+            },
+        }
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def create_bot(workdir, storage_name):
+    from bot import EhBot
+    from logstore import LogStructuredMapper
+    from mapper import TextFileMapper
+    from outbox import Outbox
+    from config import CHATS_COLLECTION_NAME
+
+    class BenchBot(EhBot):
+
+        def process_message(self, message):
+            start = time.time()
+            try:
+                return EhBot.process_message(self, message)
+            finally:
+                self.latencies.append(time.time() - start)
+
+    os.chdir(workdir)
+    mapper_class = LogStructuredMapper if storage_name == "log" else TextFileMapper
+    storage = CountingMapper(mapper_class(CHATS_COLLECTION_NAME))
+    # the real Bot API limits would make the benchmark measure the throttling
+    outbox = Outbox(global_rate=1e6, chat_rate=1e6, group_rate=1e6)
+    bot = BenchBot(storage=storage, outbox=outbox)
+    bot.latencies = []
+    return bot, storage
+
+def run_poll(bot, updates, batch_size):
+    for i in range(0, len(updates), batch_size):
+        bot.process_updates(updates[i:i + batch_size])
+    bot.outbox.flush()
+
+def run_webhook(bot, updates):
+    app = bot.create_app()
+    for update in updates:
+        body = json.dumps(update)
+        environ = {}
+        setup_testing_defaults(environ)
+        environ.update({
+            "REQUEST_METHOD": "POST",
+            "PATH_INFO": "/",
+            "CONTENT_TYPE": "application/json",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+        })
+        app(environ, lambda status, headers, exc_info=None: None)
+
+    bot.webhook_workers.join()
+    bot.outbox.flush()
+
+def benchmark(name, api, updates, run, storage_name):
+    workdir = tempfile.mkdtemp(prefix="ehbot-bench-")
+    cwd = os.getcwd()
+    try:
+        bot, storage = create_bot(workdir, storage_name)
+        http_before = api.total()
+        start = time.time()
+        run(bot)
+        elapsed = time.time() - start
+        bot.outbox.stop()
+        storage.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    count = len(updates)
+    print("%-8s %8d %9.2f %10.0f %9.3f %9.3f %10.2f %11.2f" % (
+        name, count, elapsed, count / elapsed,
+        percentile(bot.latencies, 0.5) * 1000, percentile(bot.latencies, 0.99) * 1000,
+        storage.total() / float(count), (api.total() - http_before) / float(count)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=100, help="updates per getUpdates batch")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=["text", "log"], default="text")
+    parser.add_argument("--noise", type=float, help="share of ordinary chatter, from 0 to 1")
+    args = parser.parse_args()
+
+    api = FakeBotApi()
+    os.environ["BOT_URL"] = api.start()
+    # keep logging out of the measurement
+    logging.disable(logging.WARNING)
+
+    updates = list(generate_updates(args.updates, args.chats, args.seed, args.noise))
+    print("%-8s %8s %9s %10s %9s %9s %10s %11s" % (
+        "path", "updates", "seconds", "updates/s", "p50 ms", "p99 ms", "db/update", "http/update"))
+    benchmark("poll", api, updates, lambda bot: run_poll(bot, updates, args.batch), args.storage)
+    benchmark("webhook", api, updates, lambda bot: run_webhook(bot, updates), args.storage)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Compares the stored entity codecs: encode and decode time, and blob size.
+
+    python bench/bench_codec.py [tags per chat] [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot"))
+
+from chat import Chat
+from codec import CODECS
+from tag import Tag
+from user import User
+
+def make_chat(num_tags):
+    users = [User(1000 + i, "First%s" % i, "Last%s" % i, "user%s" % i) for i in range(5)]
+    tags = [Tag("tag number %s about dinner at 8:30pm" % i, users[i % len(users)], 1440000000 + i * 60)
+            for i in range(num_tags)]
+    return Chat("-123456789", name="Some group", tags=tags, admin="58699815")
+
+def run(num_tags, iterations):
+    chat = make_chat(num_tags)
+    print("%s tags per chat, %s iterations" % (num_tags, iterations))
+    print("%-12s %12s %12s %10s" % ("codec", "encode (us)", "decode (us)", "size (B)"))
+    for name in sorted(CODECS):
+        codec = CODECS[name]()
+        blob = codec.encode(chat)
+        encode = timeit.timeit(lambda: codec.encode(chat), number=iterations)
+        decode = timeit.timeit(lambda: codec.decode(blob), number=iterations)
+        print("%-12s %12.1f %12.1f %10d" % (name, encode / iterations * 1e6, decode / iterations * 1e6, len(blob)))
+
+if __name__ == "__main__":
+    num_tags = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    run(num_tags, iterations)
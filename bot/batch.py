@@ -0,0 +1,186 @@
+import copy
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from mapper import Mapper
+from config import *
+
+class Batch(object):
+
+    def __init__(self):
+        self.chats = {}
+        self.users = {}
+        self.dirty_chats = OrderedDict()
+        self.dirty_users = OrderedDict()
+        self.memberships = OrderedDict() # (user ID, chat ID) -> date
+
+class BatchingMapper(Mapper):
+    """
+    Wraps a mapper so a whole batch of updates can run against in-memory
+    copies of the chats and users it touches. Inside a batch() scope every
+    chat and user is loaded from the wrapped mapper at most once, changes
+    are applied in memory, and each modified chat and user is written back
+    once when the scope ends. Outside of a batch it is transparent.
+
+    Batches hold no locks, so they assume a single writer per chat.
+
+    Tags of a mapper with row_tags are read and written through it right
+    away, as single rows, instead of through the chat's in-memory copy.
+    """
+
+    def __init__(self, mapper):
+        super(BatchingMapper, self).__init__(mapper.db_name)
+        self.mapper = mapper
+        self._local = threading.local()
+
+    @contextmanager
+    def batch(self):
+        if self._batch() is not None:
+            yield
+            return
+
+        batch = Batch()
+        self._local.batch = batch
+        try:
+            yield
+        finally:
+            self._local.batch = None
+
+        self.flush(batch)
+
+    def flush(self, batch):
+        with self.mapper.transaction():
+            for chat in batch.dirty_chats.values():
+                self.mapper.save_chat(chat)
+            for user in batch.dirty_users.values():
+                self.mapper.save_user(user)
+            if batch.memberships:
+                self.mapper.add_memberships([(u, c, d) for (u, c), d in batch.memberships.items()])
+
+    def transaction(self):
+        if self._batch() is not None:
+            # the batch is written in one transaction when it is flushed
+            return super(BatchingMapper, self).transaction()
+        return self.mapper.transaction()
+
+    def get_chat_by_id(self, id):
+        batch = self._batch()
+        if batch is None:
+            return self.mapper.get_chat_by_id(id)
+
+        if id not in batch.chats:
+            # copied so the wrapped mapper's cached objects stay untouched until flushed
+            batch.chats[id] = copy.deepcopy(self.mapper.get_chat_by_id(id))
+        return batch.chats[id]
+
+    def get_chats(self, chat_ids):
+        batch = self._tag_batch()
+        if batch is None:
+            return self.mapper.get_chats(chat_ids)
+
+        missing = [id for id in chat_ids if id not in batch.chats]
+        if missing:
+            # one multi-get for the chats the batch hasn't loaded yet
+            found = self.mapper.get_chats(missing)
+            for id in missing:
+                batch.chats[id] = copy.deepcopy(found.get(id))
+        return dict((id, batch.chats[id]) for id in chat_ids if batch.chats[id])
+
+    def save_chat(self, chat):
+        batch = self._batch()
+        if batch is None:
+            return self.mapper.save_chat(chat)
+
+        batch.chats[chat.id] = chat
+        batch.dirty_chats[chat.id] = chat
+
+    def get_user_by_id(self, id):
+        batch = self._batch()
+        if batch is None:
+            return self.mapper.get_user_by_id(id)
+
+        if id not in batch.users:
+            batch.users[id] = copy.deepcopy(self.mapper.get_user_by_id(id))
+        return batch.users[id]
+
+    def save_user(self, user):
+        batch = self._batch()
+        if batch is None:
+            return self.mapper.save_user(user)
+
+        batch.users[user.id] = user
+        batch.dirty_users[user.id] = user
+
+    # inside a batch the generic Mapper implementations work on the
+    # in-memory chats, outside of it the wrapped mapper's own are used
+
+    def update_chat(self, chat_id, func):
+        if self._batch() is None:
+            return self.mapper.update_chat(chat_id, func)
+        return super(BatchingMapper, self).update_chat(chat_id, func)
+
+    def get_tags(self, chat_id):
+        if self._tag_batch() is None:
+            return self.mapper.get_tags(chat_id)
+        return super(BatchingMapper, self).get_tags(chat_id)
+
+    def get_tags_page(self, chat_id, skip, limit):
+        if self._tag_batch() is None:
+            return self.mapper.get_tags_page(chat_id, skip, limit)
+        return super(BatchingMapper, self).get_tags_page(chat_id, skip, limit)
+
+    def add_tag(self, chat_id, tag, *args, **kwargs):
+        if self._tag_batch() is None:
+            return self.mapper.add_tag(chat_id, tag, *args, **kwargs)
+        return super(BatchingMapper, self).add_tag(chat_id, tag, *args, **kwargs)
+
+    def delete_tag(self, chat_id, tag):
+        if self._tag_batch() is None:
+            return self.mapper.delete_tag(chat_id, tag)
+        return super(BatchingMapper, self).delete_tag(chat_id, tag)
+
+    def add_membership(self, user_id, chat_id, date):
+        batch = self._batch()
+        if batch is None:
+            return self.mapper.add_membership(user_id, chat_id, date)
+
+        key = (user_id, chat_id)
+        batch.memberships[key] = max(batch.memberships.get(key, 0), date)
+
+    def add_memberships(self, memberships):
+        for user_id, chat_id, date in memberships:
+            self.add_membership(user_id, chat_id, date)
+
+    def get_user_chats(self, user_id, limit=DIGEST_MAX_CHATS):
+        batch = self._batch()
+        chats = self.mapper.get_user_chats(user_id, limit)
+        if batch is None:
+            return chats
+
+        # the batch's own memberships are the most recent ones
+        pending = [(d, c) for (u, c), d in batch.memberships.items() if u == user_id]
+        recent = [c for d, c in sorted(pending, reverse=True)]
+        return (recent + [c for c in chats if c not in recent])[:limit]
+
+    def get_retention(self, chat_id):
+        if self._tag_batch() is None:
+            return self.mapper.get_retention(chat_id)
+        return super(BatchingMapper, self).get_retention(chat_id)
+
+    def set_max_tags(self, chat_id, max_tags):
+        if self._tag_batch() is None:
+            return self.mapper.set_max_tags(chat_id, max_tags)
+        return super(BatchingMapper, self).set_max_tags(chat_id, max_tags)
+
+    def _batch(self):
+        return getattr(self._local, "batch", None)
+
+    def _tag_batch(self):
+        """
+        Returns the batch that tag operations go through, None when the
+        wrapped mapper stores tags as rows
+        """
+        if self.mapper.row_tags:
+            return None
+        return self._batch()
@@ -1,21 +1,44 @@
 import json
+import multiprocessing
+import Queue
+import re
+import signal
+import threading
 import time
 import sys
 import traceback
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import bottle
 
 import logger
+import metrics
 import migration
-from chat import Chat
+import requester
+from dedup import UpdateDeduplicator
 from message import Message
 from message import message_from_json
 from tag import Tag
 from mapper import PostgreSQLMapper
+from relational import RelationalMapper
+from logstore import LogStructuredMapper
+from cache import CachedMapper
+from batch import BatchingMapper
 from config import *
+from offset import Checkpointer
+from offset import FileOffsetStore
+from offset import PostgreSQLOffsetStore
+from outbox import Outbox
+from pool import DATA_ERRORS
+from ratelimit import SlidingWindowLimiter
+from render import TldrRenderer
+from render import split_message
+from search import TagIndex
+from workers import ShardedWorkerPool
+from workers import WorkerPoolStoppedException
+from requester import GetChatMemberRequest
 from requester import GetUpdatesRequest
-from requester import SendMessageRequest
 from requester import SetWebhookRequest
 
 
@@ -31,31 +54,85 @@ Or use the /tag command.
 Commands:
 
 /chatid - Returns the ID of the current chat.
-/tldr <chat_id> - Gets the tags from a chat. <chat_id> is optional and defaults to the current chat. If /tldr is sent without <chat_id> and as a private message to @EhBot, it will reply with your last requested /tldr chat.
+/tldr all - Gets the recent tags of every chat you tagged or asked for a /tldr of.
+/tldr <chat_id> page <n> - Gets the tags from a chat. <chat_id> is optional and defaults to the current chat. If /tldr is sent without <chat_id> and as a private message to @EhBot, it will reply with your last requested /tldr chat. page <n> is optional, page 1 has the most recent tags.
 /tag <text> - Adds a tag to the current chat.
 /deletetag <num> <chat_id> - Deletes tag from a chat. <num> should be a tag that you own. <chat_id> is optional and defaults to the current chat.
+/search <terms> <chat_id> - Finds the most recent tags of a chat with words starting with every term. <chat_id> is optional and defaults to the current chat.
+/retention <num> - Sets how many tags the current chat keeps, the oldest ones are dropped. Only the chat's admins can change it.
 """
 BOT_TAG = "@ehbot"
+# the command of a message's text, see get_command
+COMMAND = re.compile(r"/(?:(?P<tldr>tldr)|(?P<chatid>chatid)|(?P<tag>tag )|(?P<deletetag>deletetag )|"
+                     r"(?P<retention>retention )|(?P<search>search ))|.*?(?P<mention>%s)" % BOT_TAG,
+                     re.IGNORECASE | re.DOTALL | re.UNICODE)
+# anything in a raw update that could be a command, slashes may come escaped
+TRIGGER = re.compile(r"\\?/(?:help|tldr|chatid|tag |deletetag |retention |search )|%s" % BOT_TAG, re.IGNORECASE)
 
 class EhBot:
 
-    def __init__(self):
+    def __init__(self, storage=None, outbox=None):
+        # named explicitly, run as a script this module is __main__
+        self.logger = logger.get_logger("bot")
+        self.mapper = self.create_mapper(storage)
         if PENDING_MIGRATION:
-            migration.do()
-
-        update_id = "0"
-        try:
-            f = open(LAST_UPDATE_ID_FILE)
-            update_id = f.read().split('\n')[0]
-            f.close()
-        except:
-            pass
+            self.migrate_legacy_chats()
+
+        self.checkpointer = Checkpointer(self.create_offset_store())
+        self.last_update_id = self.checkpointer.load()
+        self.deduplicator = UpdateDeduplicator()
+        self.outbox = outbox or Outbox()
+        self.rate_limiter = SlidingWindowLimiter()
+        self.renderer = TldrRenderer()
+        self.search_index = TagIndex()
+        self.shards = None
+        self.shard_metrics = None
+        self.webhook_workers = None
+        self._local = threading.local()
+        self.register_metrics()
+
+    def create_mapper(self, storage=None):
+        """
+        Wraps the storage mapper (PostgreSQL by default) in the cache and
+        batching layers
+        """
+        if storage:
+            mapper = storage
+        elif STORAGE_BACKEND == "relational":
+            mapper = RelationalMapper(CHATS_COLLECTION_NAME)
+        elif STORAGE_BACKEND == "log":
+            mapper = LogStructuredMapper(CHATS_COLLECTION_NAME)
+        else:
+            mapper = PostgreSQLMapper(CHATS_COLLECTION_NAME)
+        self.storage = mapper
+
+        self.cache = None
+        if CACHE_SIZE > 0:
+            mapper = self.cache = CachedMapper(mapper)
+        return BatchingMapper(mapper)
+
+    def migrate_legacy_chats(self):
+        if not isinstance(self.storage, PostgreSQLMapper):
+            self.logger.warn("Legacy chats can only be migrated into PostgreSQL")
+        elif isinstance(self.storage, RelationalMapper):
+            # legacy tags are added alongside the ones the bot stores meanwhile
+            migration.start(self.storage)
+        else:
+            # a chat blob saved before its legacy row is loaded would hide the legacy tags
+            migration.Migration(self.storage).run()
 
-        self.mapper = PostgreSQLMapper(CHATS_COLLECTION_NAME)
-        self.last_update_id = int(update_id)
-        self.logger = logger.get_logger(__name__)
+    def create_offset_store(self):
+        # saved in the batch's own transaction, so saving it costs no extra commit
+        self.transactional_offset = OFFSET_STORE == "postgresql"
+        if self.transactional_offset:
+            return PostgreSQLOffsetStore(self.storage.pool)
+        return FileOffsetStore(LAST_UPDATE_ID_FILE)
 
     def start(self):
+        # stop gracefully when the dyno is shut down, like on Ctrl-C
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        signal.signal(signal.SIGUSR1, self.handle_sigusr1)
+
         if ENVIRONMENT == "heroku":
             self.run_webhook()
         else:
@@ -70,13 +147,34 @@ class EhBot:
         if response.status_code != 200 or not content["ok"]:
             raise InvalidWebhookException("Telegram response: %s" % content)
 
+        self.create_app()
+        try:
+            self._app.run(host=BOTTLE_HOST, port=sys.argv[1])
+        finally:
+            self.logger.info("Shutting down, handling pending updates")
+            self.webhook_workers.stop()
+            self.outbox.stop()
+            self.rate_limiter.save()
+            self.deduplicator.save()
+            self.storage.close()
+
+    def create_app(self):
+        self.webhook_workers = ShardedWorkerPool(self.process_update, WEBHOOK_WORKERS,
+                                                 WEBHOOK_QUEUE_SIZE, "webhook")
         self._app = bottle.Bottle()
         self.map_routes()
-        self._app.run(host=BOTTLE_HOST, port=sys.argv[1])
+        return self._app
+
+    def handle_sigterm(self, signum, frame):
+        raise KeyboardInterrupt()
+
+    def handle_sigusr1(self, signum, frame):
+        self.dump_metrics()
 
     def map_routes(self):
         self._app.route("/", method="POST", callback=self.handle_push_notification)
         self._app.route("/", method="GET", callback=self.handle_health)
+        self._app.route("/metrics", method="GET", callback=self.handle_metrics)
 
     def run_poll(self):
         # disabling webhook
@@ -85,17 +183,53 @@ class EhBot:
         if response.status_code != 200 or not content["ok"]:
             raise InvalidWebhookException("Telegram response: %s" % content)
 
-        while True:
-            try:
-                self.poll()
-            except Exception as e:
-                self.logger.error(str(traceback.format_exc()))
-                self.logger.error(e)
-
-            time.sleep(POLL_PERIOD)
+        if POLL_SHARDS > 0:
+            handler, initializer, finalizer = self.process_chat_messages, None, None
+            if SHARD_PROCESSES:
+                if STORAGE_BACKEND == "log":
+                    # each process would index and compact the same file on its own
+                    raise ShardException("The log store can't be shared by shard processes")
+                handler = self.process_forked_chat_messages
+                initializer, finalizer = self.reset_after_fork, self.stop_shard_process
+                self.shard_metrics = multiprocessing.Queue()
+            self.shards = ShardedWorkerPool(handler, POLL_SHARDS, name="shard",
+                                            processes=SHARD_PROCESSES, initializer=initializer,
+                                            finalizer=finalizer, keep_failed=True)
+
+        backoff = 0
+        last_dump = time.time()
+        try:
+            while True:
+                try:
+                    self.poll()
+                    backoff = 0
+                except Exception as e:
+                    self.logger.error(str(traceback.format_exc()))
+                    self.logger.error(e)
+                    backoff = min(max(backoff * 2, POLL_PERIOD), POLL_MAX_BACKOFF)
+
+                # long polls return as soon as there are updates, poll again right away
+                if backoff:
+                    time.sleep(backoff)
+                elif not LONG_POLL_TIMEOUT:
+                    time.sleep(POLL_PERIOD)
+
+                # there is no /metrics endpoint without the webhook server
+                if METRICS_DUMP_PERIOD and time.time() - last_dump >= METRICS_DUMP_PERIOD:
+                    self.dump_metrics()
+                    last_dump = time.time()
+        finally:
+            if self.shards:
+                self.shards.stop()
+                self.merge_shard_metrics()
+            self.checkpointer.flush()
+            self.outbox.stop()
+            self.rate_limiter.save()
+            self.deduplicator.save()
+            self.storage.close()
 
     def poll(self):
-        request = GetUpdatesRequest(offset = self.last_update_id)
+        request = GetUpdatesRequest(offset=self.last_update_id, timeout=LONG_POLL_TIMEOUT)
         response, content = request.do()
         if response.status_code != 200 or not content["ok"]:
             raise GetUpdatesException("Failed to get updates")
@@ -105,69 +239,354 @@ class EhBot:
     def handle_health(self):
         return "I'm fine"
 
+    def handle_metrics(self):
+        bottle.response.content_type = "text/plain; version=0.0.4"
+        return metrics.REGISTRY.render()
+
+    def dump_metrics(self):
+        self.merge_shard_metrics()
+        self.logger.info("Metrics:\n%s" % metrics.REGISTRY.render())
+
+    def register_metrics(self):
+        """
+        Exposes the stats the outbox, the cache and the work queues keep
+        themselves, read whenever the metrics are rendered
+        """
+        def queue_depths():
+            depths = [({"queue": "outbox"}, self.outbox.stats()["queue_depth"])]
+            for name, pool in [("webhook", self.webhook_workers), ("shards", self.shards)]:
+                if pool:
+                    depths.append(({"queue": name}, pool.depth()))
+            return depths
+
+        def outbox_stat(key):
+            return lambda: [({}, self.outbox.stats()[key])]
+
+        def cache_stat(key):
+            if not self.cache:
+                return lambda: []
+            return lambda: [({"cache": name}, stats[key]) for name, stats in sorted(self.cache.stats().items())]
+
+        registry = metrics.REGISTRY
+        registry.add(metrics.Gauge("ehbot_queue_depth", "Items waiting in each work queue.", queue_depths))
+        registry.add(metrics.Gauge("ehbot_outbox_sent_total", "Messages sent.", outbox_stat("sent"), "counter"))
+        registry.add(metrics.Gauge("ehbot_outbox_failed_total", "Messages given up on.", outbox_stat("failed"), "counter"))
+        registry.add(metrics.Gauge("ehbot_outbox_retries_total", "Send attempts that were retried.",
+                                   outbox_stat("retries"), "counter"))
+        registry.add(metrics.Gauge("ehbot_outbox_coalesced_total", "Replies merged into another message.",
+                                   outbox_stat("coalesced"), "counter"))
+        registry.add(metrics.Gauge("ehbot_outbox_latency_avg_seconds", "Average time from queued to sent.",
+                                   outbox_stat("latency_avg")))
+        registry.add(metrics.Gauge("ehbot_outbox_latency_max_seconds", "Longest time from queued to sent.",
+                                   outbox_stat("latency_max")))
+        registry.add(metrics.Gauge("ehbot_cache_entries", "Entries in each cache.", cache_stat("size")))
+        registry.add(metrics.Gauge("ehbot_cache_hits_total", "Cache hits.", cache_stat("hits"), "counter"))
+        registry.add(metrics.Gauge("ehbot_cache_misses_total", "Cache misses.", cache_stat("misses"), "counter"))
+        registry.add(metrics.Gauge("ehbot_cache_evictions_total", "Cache evictions.", cache_stat("evictions"),
+                                   "counter"))
+
     def handle_push_notification(self):
+        """
+        Queues the update and acknowledges it right away, the workers
+        handle it in the background. Updates of the same chat are handled
+        in order. When the queue stays full Telegram is asked to retry.
+        """
+        body = bottle.request.body.read()
+        # most updates are chatter, they are acknowledged without parsing them
+        if not TRIGGER.search(body):
+            metrics.MESSAGES_IGNORED.inc()
+            return
+
         try:
-            content = json.load(bottle.request.body)
-            self.logger.info("Loaded from webhook: %s" % content)
-            self.process_update(content)
-        except Exception as e:
-            self.logger.error(str(traceback.format_exc()))
-            self.logger.error(e)
+            content = json.loads(body)
+        except ValueError as e:
+            self.logger.error("Invalid update from webhook: %s" % e)
+            bottle.response.status = 400
+            return
+
+        self.logger.debug("Loaded from webhook: %s", logger.Truncated(content))
+        chat_id = content.get("message", {}).get("chat", {}).get("id")
+        try:
+            self.webhook_workers.submit(chat_id, content, timeout=WEBHOOK_QUEUE_TIMEOUT)
+        except (Queue.Full, WorkerPoolStoppedException):
+            self.logger.warn("Webhook queue is full, rejecting update %s" % content.get("update_id"))
+            bottle.response.status = 503
 
     def get_messages(self, results):
-        return [message_from_json(m["message"]) for m in results if "message" in m]
+        """
+        Returns the messages of the updates that are for the bot, the
+        others are only counted
+        """
+        messages = []
+        for update in results:
+            message = update.get("message")
+            if message is None:
+                continue
+            if self.get_command(message.get("text")):
+                messages.append(message_from_json(message, update.get("update_id")))
+            else:
+                metrics.MESSAGES_IGNORED.inc()
+        return messages
 
     def get_last_update_id(self, results):
         return results[-1]["update_id"] if results else None
 
     def process_updates(self, updates):
-        messages = self.get_messages(updates)
+        # updates handled before the offset was saved, or sent again
+        fresh = self.deduplicator.filter(updates)
+        messages = self.get_messages(fresh)
         last_update_id = self.get_last_update_id(updates)
-        self.process_messages(messages)
+        if self.shards:
+            self.process_sharded(messages)
+            self.save_last_update_id(last_update_id)
+        elif BATCH_PROCESSING:
+            # with a database offset store the offset commits with the batch's writes,
+            # so a batch is never replayed nor skipped after a crash. Any other store
+            # is only written once the batch committed.
+            previous = self.last_update_id
+            try:
+                with self.transaction():
+                    self.process_batch(messages)
+                    if self.transactional_offset:
+                        self.save_last_update_id(last_update_id, save=True)
+            except DATA_ERRORS as e:
+                self.rewind_last_update_id(previous)
+                # the update with bad data is dropped, the others are handled without it
+                self.logger.warn("Batch failed, handling its updates one by one: %s" % e)
+                self.process_messages(messages)
+            except:
+                self.rewind_last_update_id(previous)
+                raise
+            self.save_last_update_id(last_update_id, save=self.transactional_offset)
+        else:
+            self.process_messages(messages)
+            self.save_last_update_id(last_update_id)
+        self.deduplicator.record(fresh)
+        # replies of the batch to the same chat go out merged
+        self.outbox.release()
 
-        self.save_last_update_id(last_update_id)
+    def process_batch(self, messages):
+        """
+        Handles the messages against in-memory copies of the chats and
+        users they touch, then writes each modified one once. Messages are
+        handled in the order they arrived, commands can read or change
+        chats other than their own.
+        """
+        with self.mapper.batch():
+            for message in messages:
+                self.process_message(message)
+
+    def process_sharded(self, messages):
+        """
+        Hands the messages of each chat to the shard that owns the chat and
+        waits until every shard is done with the batch, so the offset only
+        advances past updates that were all handled. A command that changes
+        another chat goes to that chat's shard, its only writer.
+        """
+        for chat_id, chat_messages in self.group_by_chat(messages):
+            self.shards.submit(chat_id, chat_messages)
+
+        failed = self.shards.join()
+        self.merge_shard_metrics()
+        if failed:
+            # the chats that succeeded are not handled again when the batch is retried
+            failed_ids = set(m.update_id for chat_messages in failed for m in chat_messages)
+            self.deduplicator.record_messages([m for m in messages if m.update_id not in failed_ids])
+            raise ShardException("Failed to process updates of %s chats" % len(failed))
+
+    def process_chat_messages(self, messages):
+        if BATCH_PROCESSING:
+            try:
+                with self.transaction():
+                    self.process_batch(messages)
+            except DATA_ERRORS as e:
+                self.logger.warn("Batch failed, handling its updates one by one: %s" % e)
+                self.process_messages(messages)
+        else:
+            for i, message in enumerate(messages):
+                try:
+                    self.process_messages([message])
+                except:
+                    # the pool reports the messages left as failed, the committed ones are done
+                    del messages[:i]
+                    raise
+        self.outbox.release()
+
+    def process_forked_chat_messages(self, messages):
+        """
+        Handler of shard processes. Only the parent renders metrics, so
+        what the process counted and timed is sent over with every item;
+        the gauges of its own outbox and caches are not.
+        """
+        try:
+            self.process_chat_messages(messages)
+        finally:
+            self.shard_metrics.put(metrics.REGISTRY.drain())
+
+    def merge_shard_metrics(self):
+        if not self.shard_metrics:
+            return
+
+        while True:
+            try:
+                metrics.REGISTRY.merge(self.shard_metrics.get_nowait())
+            except Queue.Empty:
+                return
+
+    def reset_after_fork(self, shard):
+        """
+        Replaces what a forked shard process can't share with its parent:
+        database and HTTP connections, the outbox threads and the rate
+        limiter state, which is kept per shard. Its rendered /tldr pages
+        and search index only see the changes of other shards once they
+        expire, so they expire as soon as the mapper cache.
+        """
+        # kept referenced so the parent's connections are never closed from here
+        self._parent_mapper = self.mapper
+        # forked along with the parent's counts, only the ones made here are sent over
+        metrics.REGISTRY.drain()
+        requester.reset_session()
+        self.mapper = self.create_mapper()
+        self.outbox = Outbox()
+        self.renderer = TldrRenderer(ttl=CACHE_TTL)
+        self.search_index = TagIndex(ttl=CACHE_TTL)
+        # the parent records what the shards handled, from what they report failed
+        self.deduplicator = UpdateDeduplicator(path="")
+        if RATE_LIMIT_STATE_FILE:
+            self.rate_limiter = SlidingWindowLimiter(path="%s.%s" % (RATE_LIMIT_STATE_FILE, shard))
+
+    def stop_shard_process(self):
+        self.outbox.stop()
+        self.rate_limiter.save()
+        self.storage.close()
+
+    def group_by_chat(self, messages):
+        groups = OrderedDict()
+        for message in messages:
+            groups.setdefault(self.target_chat_id(message), []).append(message)
+        return groups.items()
+
+    def target_chat_id(self, message):
+        """
+        Returns the chat the message's command changes, the one it was sent
+        in except for '/deletetag <num> <chat_id>'
+        """
+        if self.get_command(message.text) == "deletetag":
+            command = message.text.split(" ")
+            if len(command) >= 3:
+                return command[2]
+        return message.chat_id
 
     def process_update(self, update_json):
-        message = message_from_json(update_json["message"])
-        self.process_messages([message])
+        # Telegram sends an update again when the webhook was slow to answer it
+        if self.deduplicator.is_duplicate(update_json):
+            return
+
+        self.process_messages(self.get_messages([update_json]))
+        self.deduplicator.record([update_json])
 
     def process_messages(self, messages):
 
         for message in messages:
-            chat_id = message.chat_id
-            text = message.text
-            if not text:
-                continue
-
-            if text == "/help":
-                self.process_help(chat_id)
+            # one transaction per update, on a single pooled connection
+            try:
+                with self.transaction():
+                    self.process_message(message)
+            except DATA_ERRORS as e:
+                # retrying it would fail the same way and hold back every later update
+                self.logger.error("Dropping update %s, its data can't be stored: %s" % (message.update_id, e))
+                metrics.UPDATES_DROPPED.inc()
+            self.deduplicator.record_messages([message])
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in one mapper transaction. Its replies are only sent
+        once it commits, and dropped if it fails.
+        """
+        if getattr(self._local, "changed", None) is not None:
+            with self.mapper.transaction():
+                yield
+            return
 
-            elif text.lower().find("/tldr") == 0:
-                self.process_tldr_query(message)
+        changed = self._local.changed = []
+        with self.outbox.hold():
+            try:
+                with self.mapper.transaction():
+                    yield
+            except:
+                # the tags given to the search index were rolled back
+                for chat_id, _, _ in changed:
+                    self.update_chat_views(chat_id)
+                raise
+            else:
+                # others may have rendered or indexed the chats from before the commit
+                for chat_id, added, deleted in changed:
+                    self.update_chat_views(chat_id, added, deleted)
+            finally:
+                self._local.changed = None
+
+    def chat_changed(self, chat_id, added=None, deleted=None):
+        """
+        Updates the chat's rendered /tldr pages and search index after its
+        tags changed, right away for the commands of the same transaction
+        and again once the transaction ends
+        """
+        self.update_chat_views(chat_id, added, deleted)
+        changed = getattr(self._local, "changed", None)
+        if changed is not None:
+            changed.append((chat_id, added, deleted))
+
+    def update_chat_views(self, chat_id, added=None, deleted=None):
+        # without the tag added or deleted the chat is indexed again
+        self.renderer.invalidate(chat_id)
+        if added:
+            self.search_index.add(chat_id, added)
+        elif deleted:
+            self.search_index.remove(chat_id, deleted)
+        else:
+            self.search_index.invalidate(chat_id)
 
-            elif text.lower().find("/chatid") == 0:
-                self.process_chat_id_query(chat_id)
+    def process_message(self, message):
+        command = self.get_command(message.text)
+        if not command:
+            metrics.MESSAGES_IGNORED.inc()
+            return
 
-            elif text.lower().find("/tag ") == 0:
+        with metrics.MESSAGE_SECONDS.time(command=command):
+            if command == "help":
+                self.process_help(message.chat_id)
+            elif command == "tldr":
+                self.process_tldr_query(message)
+            elif command == "chatid":
+                self.process_chat_id_query(message.chat_id)
+            elif command == "tag":
                 self.process_tag_command(message)
-
-            elif text.lower().find("/deletetag ") == 0:
+            elif command == "deletetag":
                 self.process_delete_tag_command(message)
-
-            elif BOT_TAG in text.lower():
+            elif command == "retention":
+                self.process_retention_command(message)
+            elif command == "search":
+                self.process_search_query(message)
+            elif command == "mention":
                 self.process_tag_mention(message)
 
+    def get_command(self, text):
+        if not text:
+            return None
+
+        if text == "/help":
+            return "help"
+
+        match = COMMAND.match(text)
+        return match.lastgroup if match else None
+
     def process_help(self, chat_id):
-        request = SendMessageRequest(chat_id, HELP)
-        response, content = request.do()
-        if response.status_code != 200 or not content["ok"]:
-            raise "Failed to send /help"
+        self.send_message(chat_id, HELP)
 
     def process_tag_command(self, message):
-        chat_id = message.chat_id
         try:
-            tag = self.get_tag_from_message(message, lambda text: text.split("/tag")[-1].strip())
-            self.add_tag(chat_id, tag)
+            self.add_tag(message, lambda text: text.split("/tag")[-1].strip())
         except UserTagLimitException as e:
             self.send_warning_to_user(message.user.id, "Stop spamming")
             self.logger.warn(e.message)
@@ -176,27 +595,26 @@ class EhBot:
         """
         Takes a message that mentions EhBot and stores it as a tag
         """
-        chat_id = message.chat_id
         try:
-            tag = self.get_tag_from_message(message, self.get_tag_text_from_mention)
-            self.add_tag(chat_id, tag)
+            self.add_tag(message, self.get_tag_text_from_mention)
         except UserTagLimitException as e:
             self.send_warning_to_user(message.user.id, "Stop spamming")
             self.logger.warn(e.message)
 
     def process_chat_id_query(self, chat_id):
         text = "This chat's ID: {}\nUse it to call '/tldr {}'".format(chat_id, chat_id)
-        request = SendMessageRequest(chat_id, text)
-        response, content = request.do()
-        if response.status_code != 200 or not content["ok"]:
-            raise "Failed to send /help"
+        self.send_message(chat_id, text)
 
     def process_tldr_query(self, message):
+        query_chat, page = self.parse_tldr_query(message.text)
+        if query_chat.lower() == "all":
+            self.send_digest(message)
+            return
+
         # try to get it from DB
         user = self.mapper.get_user_by_id(message.user.id)
         if not user: user = message.user
 
-        query_chat = message.text.split("/tldr")[-1].strip()
         query_chat_id = None
 
         if query_chat: # chat id specified
@@ -209,11 +627,27 @@ class EhBot:
             query_chat_id = message.chat_id
             user.last_tldr = query_chat_id
 
-        self.send_tags(user.id, query_chat_id)
+        found = self.send_tags(user.id, query_chat_id, page)
         self.mapper.save_user(user)
+        # the query may be any text, only chats that exist are worth a digest
+        if found:
+            self.mapper.add_membership(user.id, query_chat_id, message.date)
+
+    def parse_tldr_query(self, text):
+        """
+        Splits '/tldr <chat_id> page <n>' into the chat ID, which may be
+        empty, and the page number
+        """
+        words = text.split("/tldr")[-1].split()
+        page = 1
+        if len(words) >= 2 and words[-2].lower() == "page" and words[-1].isdigit():
+            page = max(int(words[-1]), 1)
+            words = words[:-2]
+        return " ".join(words), page
 
     def process_delete_tag_command(self, message):
         chat_id = message.chat_id
+        user_id = message.user.id
         command = message.text.split(" ")
         tag_num = command[1]
         if len(command) >= 3:
@@ -221,77 +655,145 @@ class EhBot:
 
         if not tag_num.isdigit():
             self.send_warning_to_user(user_id, "Tag number is not valid")
+            return
 
         tag_num = int(tag_num) - 1
 
-        user_id = message.user.id
-        chat = self.mapper.get_chat_by_id(chat_id)
-        if not chat:
+        tags = self.mapper.get_tags(chat_id)
+        if not tags:
             self.send_warning_to_user(user_id, "Chat doesn't have any tags")
-        elif tag_num < 0 or tag_num >= len(chat.tags):
+        elif tag_num < 0 or tag_num >= len(tags):
             self.send_warning_to_user(user_id, "Tag number is out of range")
-        elif chat.tags[tag_num].user.id != user_id:
+        elif tags[tag_num].user.id != user_id:
             # owns the tag?
             self.send_warning_to_user(user_id, "This tag is not yours")
         else:
-            tag = chat.tags.pop(tag_num)
-            self.mapper.save_chat(chat)
+            tag = tags[tag_num]
+            self.mapper.delete_tag(chat_id, tag)
+            self.chat_changed(chat_id, deleted=tag)
             self.send_warning_to_user(user_id, "Tag '%s' deleted" % tag.text)
 
-    def send_tags(self, chat_id, query_chat_id):
-        tags_text = ""
-        chat = self.mapper.get_chat_by_id(query_chat_id)
-        if not chat or len(chat.tags) == 0:
-            tags_text = "No Tags found for this chat"
-        else:
-            tags = ["%s. %s" % (i+1, t.pretty_print()) for i, t in enumerate(chat.tags)]
-            tags_text = "\n".join(tags)
-            tags_text = "Tags for chat %s:\n%s" % (query_chat_id, tags_text)
+    def process_retention_command(self, message):
+        max_tags = message.text.split(" ")[1]
+        if not max_tags.isdigit() or not 1 <= int(max_tags) <= MAX_TAGS_LIMIT:
+            self.send_warning_to_user(message.user.id, "Retention must be between 1 and %s tags" % MAX_TAGS_LIMIT)
+            return
+        if not self.is_chat_admin(message.chat_id, message.user.id):
+            # lowering it deletes everyone's oldest tags
+            self.send_warning_to_user(message.user.id, "Only the chat's admins can change its retention")
+            return
+
+        self.mapper.set_max_tags(message.chat_id, int(max_tags))
+        self.chat_changed(message.chat_id)
+        self.send_message(message.chat_id, "This chat keeps its last %s tags" % max_tags)
 
-        request = SendMessageRequest(chat_id, tags_text)
+    def is_chat_admin(self, chat_id, user_id):
+        """
+        Whether the user is the chat's stored admin, an administrator of
+        the group or the other end of a private chat
+        """
+        if chat_id == user_id:
+            return True
+
+        chat = self.mapper.get_chat_by_id(chat_id)
+        if chat and chat.admin is not None and str(chat.admin) == user_id:
+            return True
+
+        request = GetChatMemberRequest(chat_id, user_id)
         response, content = request.do()
         if response.status_code != 200 or not content["ok"]:
-            raise "Failed to send /tldr"
+            return False
+        return content["result"].get("status") in ("creator", "administrator")
+
+    def process_search_query(self, message):
+        words = message.text.split()[1:]
+        chat_id = message.chat_id
+        # chat IDs are long numbers, shorter ones are taken as search terms
+        if len(words) > 1 and re.match(r"^-?\d{6,}$", words[-1]):
+            chat_id = words.pop()
+
+        load_chat = lambda: (self.mapper.get_tags(chat_id), self.mapper.get_retention(chat_id))
+        results = self.search_index.search(chat_id, " ".join(words), load_chat)
+        if not results:
+            self.send_message(message.user.id, "No tags found for '%s'" % " ".join(words))
+            return
+
+        lines = ["%s. %s" % (num, self.renderer.render_tag(tag)) for num, tag in results]
+        self.send_message(message.user.id, "Tags matching '%s' in chat %s:\n%s" % (
+            " ".join(words), chat_id, "\n".join(lines)))
+
+    def send_digest(self, message):
+        """
+        Sends the user the tags added within DIGEST_WINDOW to the chats
+        they used most recently, all of them loaded at once
+        """
+        user_id = message.user.id
+        chat_ids = self.mapper.get_user_chats(user_id)
+        chats = self.mapper.get_chats(chat_ids)
+        since = message.date - DIGEST_WINDOW
+
+        sections = []
+        for chat_id in chat_ids:
+            chat = chats.get(chat_id)
+            if not chat:
+                continue
+            lines = ["%s. %s" % (i + 1, self.renderer.render_tag(t)) for i, t in enumerate(chat.tags)
+                     if t.date >= since]
+            if lines:
+                sections.append("Chat %s:\n%s" % (chat_id, "\n".join(lines)))
+
+        if not sections:
+            self.send_message(user_id, "No recent tags in your chats")
+            return
+
+        for part in split_message("Recent tags from your chats:\n\n%s" % "\n\n".join(sections)):
+            self.send_message(user_id, part)
+
+    def send_tags(self, chat_id, query_chat_id, page=1):
+        """
+        Sends a page of the chat's tags, returns whether the chat has any
+        """
+        load_page = lambda skip, limit: self.mapper.get_tags_page(query_chat_id, skip, limit)
+        tags_text, total = self.renderer.render(query_chat_id, load_page, page)
+        self.send_message(chat_id, tags_text)
+        return total > 0
 
     def send_warning_to_user(self, user_id, warning_text):
-        request = SendMessageRequest(user_id, warning_text)
-        response, content = request.do()
-        if response.status_code != 200 or not content["ok"]:
-            raise "Failed to send warning to user"
+        self.send_message(user_id, warning_text)
 
-    def add_tag(self, chat_id, tag):
-        chat = self.mapper.get_chat_by_id(chat_id)
-        if not chat:
-            chat = Chat(chat_id)
-        elif len(chat.tags) >= 5:
-            chat.tags.pop(0)
+    def send_message(self, chat_id, text):
+        """
+        Queues the message, it is sent in the background
+        """
+        self.outbox.send(chat_id, text)
 
-        chat.tags.append(tag)
-        self.mapper.save_chat(chat)
+    def add_tag(self, message, tag_func):
+        tag = self.get_tag_from_message(message, tag_func)
+        self.mapper.add_tag(message.chat_id, tag, MAX_TAGS)
+        self.mapper.add_membership(message.user.id, message.chat_id, message.date)
+        self.chat_changed(message.chat_id, added=tag)
 
-    def save_last_update_id(self, last_update_id):
+    def save_last_update_id(self, last_update_id, save=False):
         # if we found results, increment the last_update_id, else it stays the same
         if not last_update_id:
             return
 
         self.last_update_id = last_update_id + 1
-        f = open(LAST_UPDATE_ID_FILE, "w")
-        f.write(str(self.last_update_id))
-        f.close()
+        self.checkpointer.advance(self.last_update_id, save)
+
+    def rewind_last_update_id(self, last_update_id):
+        # the updates past it were rolled back
+        self.last_update_id = last_update_id
+        self.checkpointer.rewind(last_update_id)
 
     def get_tag_from_message(self, message, tag_func):
-        date = datetime.fromtimestamp(message.date)
-        chat_id = message.chat_id
         user = message.user
 
-        chat = self.mapper.get_chat_by_id(chat_id)
-        if chat:
-            for t in chat.tags:
-                d = datetime.fromtimestamp(t.date)
+        # message IDs make replayed updates pass the check they passed before
+        if not self.rate_limiter.hit("tag", (message.chat_id, user.id), message.date, message.id):
+            username = user.pretty_print()
+            raise UserTagLimitException("User '%s' is submitting too rapidly" % username)
 
-                if t.user.id == user.id and (message.date - t.date) <= 5 * 60:
-                    username = t.user.pretty_print()
-                    raise UserTagLimitException("User '%s' is submitting too rapidly" % username)
         text = tag_func(message.text)
         return Tag(text=text, user=user, date=message.date)
 
@@ -301,11 +803,16 @@ class EhBot:
 class UserTagLimitException(Exception):
     pass
 
+class ShardException(Exception):
+    pass
+
 class GetUpdatesException(Exception):
     pass
 
 class InvalidWebhookException(Exception):
     pass
 
-bot = EhBot()
-bot.start()
+if __name__ == "__main__":
+    bot = EhBot()
+    bot.start()
+
@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from mapper import Mapper
+from config import *
+
+MISSING = object()
+
+class LRUCache(object):
+    """
+    Thread-safe cache that evicts the least recently used entry once it is
+    full and expires entries older than ttl seconds
+    """
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                self.misses += 1
+                return MISSING
+
+            self._entries[key] = entry # most recently used goes last
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """
+        Returns the entry without refreshing it or counting a hit or miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return MISSING
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+class CachedMapper(Mapper):
+    """
+    Write-through cache in front of any other Mapper. Reads are served from
+    memory while fresh, every write goes to the wrapped mapper first and
+    then updates or invalidates the cached entries it affects. Entries
+    cached in a transaction that fails are dropped, they may hold its
+    writes, and the ones it invalidated are invalidated again once it
+    ends, as others may have cached them from before its commit.
+    """
+
+    def __init__(self, mapper, size=CACHE_SIZE, ttl=CACHE_TTL):
+        super(CachedMapper, self).__init__(mapper.db_name)
+        self.mapper = mapper
+        self.row_tags = mapper.row_tags
+        self.chats = LRUCache(size, ttl)
+        self.users = LRUCache(size, ttl)
+        self.tags = LRUCache(size, ttl)
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        outermost = not hasattr(self._local, "written")
+        if outermost:
+            self._local.written = []
+            self._local.invalidated = []
+
+        try:
+            with self.mapper.transaction():
+                yield
+        except:
+            if outermost:
+                for cache, key in self._local.written:
+                    cache.invalidate(key)
+            raise
+        finally:
+            if outermost:
+                for cache, key in self._local.invalidated:
+                    cache.invalidate(key)
+                del self._local.written
+                del self._local.invalidated
+
+    def get_chat_by_id(self, id):
+        chat = self.chats.get(id)
+        if chat is MISSING:
+            chat = self.mapper.get_chat_by_id(id)
+            self._put(self.chats, id, chat)
+        return chat
+
+    def get_chats(self, chat_ids):
+        chats = {}
+        missing = []
+        for chat_id in chat_ids:
+            chat = self.chats.get(chat_id)
+            if chat is MISSING:
+                missing.append(chat_id)
+            elif chat:
+                chats[chat_id] = chat
+
+        if missing:
+            found = self.mapper.get_chats(missing)
+            for chat_id in missing:
+                self._put(self.chats, chat_id, found.get(chat_id))
+            chats.update(found)
+        return chats
+
+    def save_chat(self, chat):
+        self.mapper.save_chat(chat)
+        self._put(self.chats, chat.id, chat)
+        self._invalidate(self.tags, chat.id)
+
+    def update_chat(self, chat_id, func):
+        # always modified from the wrapped mapper so it can lock the row
+        result = self.mapper.update_chat(chat_id, func)
+        self._invalidate(self.chats, chat_id)
+        self._invalidate(self.tags, chat_id)
+        return result
+
+    def get_user_by_id(self, id):
+        user = self.users.get(id)
+        if user is MISSING:
+            user = self.mapper.get_user_by_id(id)
+            self._put(self.users, id, user)
+        return user
+
+    def save_user(self, user):
+        self.mapper.save_user(user)
+        self._put(self.users, user.id, user)
+
+    def get_tags(self, chat_id):
+        tags = self.tags.get(chat_id)
+        if tags is MISSING:
+            tags = self.mapper.get_tags(chat_id)
+            self._put(self.tags, chat_id, tags)
+        return tags
+
+    def get_tags_page(self, chat_id, skip, limit):
+        if self.tags.peek(chat_id) is not MISSING:
+            return super(CachedMapper, self).get_tags_page(chat_id, skip, limit)
+        # only the page is loaded, the whole list is cached once something needs it
+        return self.mapper.get_tags_page(chat_id, skip, limit)
+
+    def add_tag(self, chat_id, tag, max_tags=MAX_TAGS):
+        self.mapper.add_tag(chat_id, tag, max_tags)
+        # the cached list may be the wrapped mapper's own, already appended
+        # to, and only it knows which old tags the retention dropped
+        self._invalidate(self.chats, chat_id)
+        self._invalidate(self.tags, chat_id)
+
+    def add_membership(self, user_id, chat_id, date):
+        self.mapper.add_membership(user_id, chat_id, date)
+
+    def add_memberships(self, memberships):
+        self.mapper.add_memberships(memberships)
+
+    def get_user_chats(self, user_id, limit=DIGEST_MAX_CHATS):
+        return self.mapper.get_user_chats(user_id, limit)
+
+    def get_retention(self, chat_id):
+        chat = self.chats.peek(chat_id)
+        if chat is MISSING:
+            return self.mapper.get_retention(chat_id)
+        return chat.retention() if chat else MAX_TAGS
+
+    def set_max_tags(self, chat_id, max_tags):
+        self.mapper.set_max_tags(chat_id, max_tags)
+        self._invalidate(self.chats, chat_id)
+        self._invalidate(self.tags, chat_id)
+
+    def delete_tag(self, chat_id, tag):
+        self.mapper.delete_tag(chat_id, tag)
+        self._invalidate(self.chats, chat_id)
+
+        tags = self.tags.peek(chat_id)
+        if tags is not MISSING:
+            self._put(self.tags, chat_id, [t for t in tags if t.key() != tag.key()])
+
+    def stats(self):
+        return {
+            "chats": self.chats.stats(),
+            "users": self.users.stats(),
+            "tags": self.tags.stats(),
+        }
+
+    def _put(self, cache, key, value):
+        cache.put(key, value)
+        written = getattr(self._local, "written", None)
+        if written is not None:
+            written.append((cache, key))
+
+    def _invalidate(self, cache, key):
+        cache.invalidate(key)
+        invalidated = getattr(self._local, "invalidated", None)
+        if invalidated is not None:
+            invalidated.append((cache, key))
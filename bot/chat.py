@@ -1,8 +1,17 @@
+from config import *
 
 class Chat(object):
 
-    def __init__(self, id, name="", tags=[], admin=None):
+    def __init__(self, id, name="", tags=None, admin=None, max_tags=None):
         self.id = str(id)
         self.name = name
-        self.tags = tags
+        self.tags = tags if tags is not None else []
         self.admin = admin
+        self.max_tags = max_tags
+
+    def retention(self, default=MAX_TAGS):
+        """
+        Number of tags the chat keeps, chats stored before it could be set
+        don't have max_tags
+        """
+        return getattr(self, "max_tags", None) or default
@@ -0,0 +1,124 @@
+import json
+
+import jsonpickle
+
+from chat import Chat
+from tag import Tag
+from user import User
+from config import *
+
+class Codec(object):
+    """
+    Turns the stored entities (chats, users, and dicts of them) into
+    strings and back
+    """
+
+    def encode(self, obj):
+        raise NotImplementedError()
+
+    def decode(self, blob):
+        raise NotImplementedError()
+
+class JsonPickleCodec(Codec):
+
+    def encode(self, obj):
+        return jsonpickle.encode(obj)
+
+    def decode(self, blob):
+        return jsonpickle.decode(blob)
+
+class CompactCodec(Codec):
+    """
+    Plain JSON with short keys and positional lists, tagged with a schema
+    version:
+
+    chat: {"v": 1, "t": "c", "i": id, "n": name, "a": admin, "g": [tag, ...], "r": max_tags}
+    tag:  [text, date, user] or [text, date, user, id]
+    user: {"v": 1, "t": "u", "u": [id, first_name, last_name, username, last_tldr]}
+    dict: {"v": 1, "t": "d", "e": {key: chat or user}}
+
+    "r" is left out while the chat keeps the default number of tags. Tags
+    embed their user as the bare list. Blobs written by jsonpickle are
+    still decoded, and get rewritten in this format the next time they are
+    saved.
+    """
+    VERSION = 1
+
+    def __init__(self):
+        self.legacy = JsonPickleCodec()
+
+    def encode(self, obj):
+        return json.dumps(self._to_data(obj), separators=(",", ":"))
+
+    def decode(self, blob):
+        data = json.loads(blob)
+        if not isinstance(data, dict) or "v" not in data or "t" not in data:
+            return self.legacy.decode(blob)
+        if data["v"] > self.VERSION:
+            raise UnknownVersionException("Can't decode schema version %s" % data["v"])
+
+        return self._from_data(data)
+
+    def _to_data(self, obj):
+        if isinstance(obj, Chat):
+            data = {
+                "v": self.VERSION,
+                "t": "c",
+                "i": obj.id,
+                "n": obj.name,
+                "a": obj.admin,
+                "g": [self._tag_to_data(t) for t in obj.tags],
+            }
+            max_tags = getattr(obj, "max_tags", None)
+            if max_tags:
+                data["r"] = max_tags
+            return data
+        elif isinstance(obj, User):
+            return {"v": self.VERSION, "t": "u", "u": self._user_to_data(obj)}
+        elif isinstance(obj, dict):
+            entities = dict((k, self._to_data(v)) for k, v in obj.items())
+            return {"v": self.VERSION, "t": "d", "e": entities}
+
+        raise TypeError("Can't encode %s" % type(obj))
+
+    def _from_data(self, data):
+        kind = data["t"]
+        if kind == "c":
+            tags = [self._tag_from_data(t) for t in data["g"]]
+            return Chat(data["i"], name=data["n"], tags=tags, admin=data["a"], max_tags=data.get("r"))
+        elif kind == "u":
+            return self._user_from_data(data["u"])
+        elif kind == "d":
+            return dict((k, self._from_data(v)) for k, v in data["e"].items())
+
+        raise TypeError("Can't decode entity type %s" % kind)
+
+    def _tag_to_data(self, tag):
+        data = [tag.text, tag.date, self._user_to_data(tag.user)]
+        tag_id = getattr(tag, "id", None)
+        if tag_id is not None:
+            data.append(tag_id)
+        return data
+
+    def _tag_from_data(self, data):
+        tag_id = data[3] if len(data) > 3 else None
+        return Tag(data[0], self._user_from_data(data[2]), data[1], id=tag_id)
+
+    def _user_to_data(self, user):
+        return [user.id, user.first_name, user.last_name, user.username, getattr(user, "last_tldr", None)]
+
+    def _user_from_data(self, data):
+        user = User(data[0], data[1], data[2], data[3])
+        user.last_tldr = data[4]
+        return user
+
+CODECS = {
+    "jsonpickle": JsonPickleCodec,
+    "compact": CompactCodec,
+}
+
+def get_codec(name=CODEC):
+    return CODECS[name]()
+
+class UnknownVersionException(Exception):
+    pass
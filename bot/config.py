@@ -8,12 +8,81 @@ ENVIRONMENT = os.getenv("ENVIRONMENT", "local")
 WEBHOOK = os.getenv("WEBHOOK", "")
 BOTTLE_PORT = os.getenv("BOTTLE_PORT", "8080")
 BOTTLE_HOST = os.getenv("BOTTLE_HOST", "127.0.0.1")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = 100 # updates waiting per worker
+WEBHOOK_QUEUE_TIMEOUT = 5 # seconds to wait for room in a full queue before rejecting an update
 LAST_UPDATE_ID_FILE = "last_update"
+OFFSET_STORE = os.getenv("OFFSET_STORE", "file") # "file" or "postgresql"
+OFFSET_CHECKPOINT_EVERY = int(os.getenv("OFFSET_CHECKPOINT_EVERY", 1)) # batches between saved offsets, a database store saves with every batch
+OFFSET_CHECKPOINT_PERIOD = 30 # seconds, an offset older than this is saved with the next batch
 CHATS_COLLECTION_NAME = "chats"
 USERS_COLLECTION_NAME = "users"
+TAGS_COLLECTION_NAME = "tags"
+MEMBERSHIPS_COLLECTION_NAME = "memberships"
 POLL_PERIOD = 1
-MAX_TAGS = 5
-LOGGING_LEVEL = logging.DEBUG
+LONG_POLL_TIMEOUT = int(os.getenv("LONG_POLL_TIMEOUT", 30)) # seconds, 0 polls every POLL_PERIOD instead
+LONG_POLL_GRACE = 10 # extra seconds to wait for a long poll response before giving up
+POLL_MAX_BACKOFF = 60 # seconds
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10)) # connections kept alive to the Bot API
+HTTP_TIMEOUT = 10 # seconds
+HTTP_RETRIES = 2 # extra attempts for idempotent requests
+HTTP_RETRY_BACKOFF = 0.5 # seconds, doubled on every retry
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4)) # 0 sends replies synchronously
+OUTBOX_QUEUE_SIZE = 100 # messages waiting per worker
+OUTBOX_GLOBAL_RATE = 30 # messages per second
+OUTBOX_CHAT_RATE = 1 # messages per second to the same user
+OUTBOX_GROUP_RATE = 20 / 60.0 # messages per second to the same group
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BACKOFF = 1 # seconds, doubled on every retry
+OUTBOX_COALESCE_WINDOW = float(os.getenv("OUTBOX_COALESCE_WINDOW", 0.5)) # seconds replies to a chat wait to be merged, 0 sends each right away
+OUTBOX_MAX_BUCKETS = 10000 # rate limited chats tracked at once
+MAX_TAGS = int(os.getenv("MAX_TAGS", 5)) # tags kept per chat unless the chat sets its own with /retention
+MAX_TAGS_LIMIT = 1000 # most tags a chat can choose to keep
+TLDR_PAGE_SIZE = int(os.getenv("TLDR_PAGE_SIZE", 10)) # tags per /tldr page
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", 7 * 24 * 3600)) # seconds of tags shown by /tldr all
+DIGEST_MAX_CHATS = 20 # most recently used chats of a user shown by /tldr all
+MAX_MESSAGE_LENGTH = 4096 # characters Telegram accepts in one message
+SEARCH_RESULTS = 10 # tags per /search reply
+SEARCH_INDEX_SIZE = 1000 # chats kept in the search index
+SEARCH_INDEX_TTL = 3600 # seconds before a chat is indexed again from storage
+RATE_LIMITS = {
+    "tag": (1, 5 * 60), # hits allowed per (chat, user) within that many seconds
+}
+RATE_LIMIT_STATE_FILE = os.getenv("RATE_LIMIT_STATE_FILE", "") # empty keeps the state in memory only
+RATE_LIMIT_SAVE_PERIOD = 60 # seconds
+RATE_LIMIT_PRUNE_EVERY = 1000 # hits
+DEDUP_SIZE = 100000 # update keys remembered, two per message
+DEDUP_TTL = 24 * 3600 # seconds, Telegram keeps undelivered updates for a day
+DEDUP_STATE_FILE = os.getenv("DEDUP_STATE_FILE", "") # empty keeps the seen updates in memory only
+DEDUP_SAVE_PERIOD = 60 # seconds
+LOGGING_LEVEL = getattr(logging, os.getenv("LOGGING_LEVEL", "INFO").upper())
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text") # "text" or "json", one object per line
+LOG_QUEUE_SIZE = 10000 # records waiting for the writer thread, more are dropped
+LOG_MAX_BODY = int(os.getenv("LOG_MAX_BODY", 500)) # characters of a request or response body that are logged
+# share of the records below WARNING kept per logger, e.g. "requester:0.01,bot:0.5"
+LOG_SAMPLING = dict((name, float(rate)) for name, rate in
+                    (item.split(":") for item in os.getenv("LOG_SAMPLING", "").split(",") if item))
 LOCAL_TIMEZONE = pytz.timezone('America/Mexico_City')
 PENDING_MIGRATION = os.getenv("PENDING_MIGRATION", False)
+LEGACY_CHATS_FILE = os.getenv("LEGACY_CHATS_FILE", "chats") # JSON of chat IDs to messages, loaded by migration.py
+MIGRATION_BATCH_SIZE = 500 # chats per COPY transaction
+MIGRATION_CHUNK_SIZE = 64 * 1024 # bytes of the legacy file read at a time
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "blob") # "blob", "relational" or "log" for a local file
+LOGSTORE_SYNC_PERIOD = float(os.getenv("LOGSTORE_SYNC_PERIOD", 1)) # seconds between fsyncs of the log, 0 syncs every write
+LOGSTORE_COMPACT_PERIOD = 60 # seconds between checks for compaction
+LOGSTORE_COMPACT_RATIO = 2 # compacts once the log is this many times the size of its live records
+LOGSTORE_COMPACT_MIN_SIZE = 1024 * 1024 # bytes
+CODEC = os.getenv("CODEC", "compact") # "compact" or "jsonpickle", both read either format
 DATABASE_URL = os.getenv("DATABASE_URL", "http://cesar@localhost:5432/ehbot")
+DB_POOL_MIN_CONN = int(os.getenv("DB_POOL_MIN_CONN", 1))
+DB_POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX_CONN", 5))
+DB_POOL_CHECK_INTERVAL = 30 # seconds a connection can sit idle before it is pinged
+DB_RECONNECT_RETRIES = 1
+RENDER_CACHE_SIZE = 1000 # chats with a cached /tldr
+RENDER_CACHE_TTL = 3600 # seconds
+POLL_SHARDS = int(os.getenv("POLL_SHARDS", 0)) # workers updates are partitioned across by chat, 0 handles them inline
+SHARD_PROCESSES = os.getenv("SHARD_PROCESSES", "0") == "1" # shard workers are processes instead of threads
+BATCH_PROCESSING = os.getenv("BATCH_PROCESSING", "1") == "1" # one write per chat for each getUpdates batch
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", 1000)) # entries per cache, 0 disables caching
+CACHE_TTL = int(os.getenv("CACHE_TTL", 300)) # seconds
+METRICS_DUMP_PERIOD = int(os.getenv("METRICS_DUMP_PERIOD", 300)) # seconds between metrics logged in poll mode, 0 disables
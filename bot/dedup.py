@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+import logger
+import metrics
+from config import *
+from statefile import load_json
+from statefile import save_json
+
+def update_keys(update_json):
+    """
+    Returns the keys an update is known by: its update_id and, for
+    messages, the chat and message IDs, which stay the same if Telegram
+    hands the message out again under a new update_id
+    """
+    keys = ["u:%s" % update_json.get("update_id")]
+    message = update_json.get("message")
+    if message:
+        keys.append("m:%s:%s" % (message.get("chat", {}).get("id"), message.get("message_id")))
+    return keys
+
+def message_keys(message):
+    """
+    Returns the keys of the update a parsed message came in
+    """
+    return ["u:%s" % message.update_id, "m:%s:%s" % (message.chat_id, message.id)]
+
+class UpdateDeduplicator(object):
+    """
+    Remembers the keys of the updates handled within the last ttl seconds,
+    at most size keys, so redelivered and replayed updates are dropped
+    before they are parsed or reach the database. The keys live in memory
+    and can be saved to a file to survive restarts.
+
+    Updates are only recorded once handled, an update that failed is not
+    a duplicate when it comes again.
+    """
+
+    def __init__(self, size=DEDUP_SIZE, ttl=DEDUP_TTL, path=DEDUP_STATE_FILE, save_period=DEDUP_SAVE_PERIOD):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.save_period = save_period
+        self.keys = OrderedDict() # key -> time it was recorded, oldest first
+        self.logger = logger.get_logger(__name__)
+        self._lock = threading.Lock()
+        self._last_save = time.time()
+        self.load()
+
+    def filter(self, updates):
+        """
+        Returns the updates that were not handled yet, dropping repeated
+        ones within updates too
+        """
+        fresh = []
+        batch_keys = set()
+        duplicates = 0
+        with self._lock:
+            self._expire(time.time())
+            for update in updates:
+                keys = update_keys(update)
+                if any(key in self.keys or key in batch_keys for key in keys):
+                    duplicates += 1
+                    continue
+                batch_keys.update(keys)
+                fresh.append(update)
+
+        if duplicates:
+            metrics.UPDATES_DUPLICATE.inc(duplicates)
+        return fresh
+
+    def is_duplicate(self, update):
+        return not self.filter([update])
+
+    def record(self, updates):
+        self._record([update_keys(update) for update in updates])
+
+    def record_messages(self, messages):
+        """
+        Records the updates of messages handled on their own, so they are
+        not handled again if a later update of their batch fails
+        """
+        self._record([message_keys(message) for message in messages])
+
+    def _record(self, keys_of_updates):
+        now = time.time()
+        with self._lock:
+            for keys in keys_of_updates:
+                for key in keys:
+                    self.keys.pop(key, None)
+                    self.keys[key] = now
+            self._expire(now)
+
+        if self.path and now - self._last_save > self.save_period:
+            self.save()
+
+    def load(self):
+        state = load_json(self.path, self.logger)
+        if state is None:
+            return
+
+        for key, recorded in state:
+            self.keys[key] = recorded
+        self._expire(time.time())
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            state = list(self.keys.items())
+            self._last_save = time.time()
+
+        save_json(self.path, state)
+
+    def _expire(self, now):
+        while self.keys:
+            key = next(iter(self.keys))
+            if len(self.keys) <= self.size and now - self.keys[key] <= self.ttl:
+                break
+            del self.keys[key]
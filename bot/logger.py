@@ -1,8 +1,19 @@
+import itertools
+import json
 import logging
+import os
+import Queue
+import threading
 
 from config import LOGGING_LEVEL
+from config import LOG_FORMAT
+from config import LOG_MAX_BODY
+from config import LOG_QUEUE_SIZE
+from config import LOG_SAMPLING
 
 loggers = {}
+_handler = None
+_handler_lock = threading.Lock()
 
 def get_logger(name):
     global loggers
@@ -12,14 +23,152 @@ def get_logger(name):
 
     logger = logging.getLogger(name)
     logger.setLevel(LOGGING_LEVEL)
+    logger.addHandler(get_handler())
 
-    formatter = logging.Formatter('%(levelname)s %(asctime)s %(name)s: %(message)s')
+    rate = LOG_SAMPLING.get(name)
+    if rate is not None:
+        logger.addFilter(SamplingFilter(rate))
 
-    ch = logging.StreamHandler()
-    ch.setLevel(LOGGING_LEVEL)
-    ch.setFormatter(formatter)
-
-    logger.addHandler(ch)
     loggers[name] = logger
 
     return logger
+
+def get_handler():
+    """
+    Returns the handler shared by every logger, which writes to stderr from
+    a background thread
+    """
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            if LOG_FORMAT == "json":
+                formatter = JsonFormatter()
+            else:
+                formatter = logging.Formatter('%(levelname)s %(asctime)s %(name)s: %(message)s')
+
+            ch = logging.StreamHandler()
+            ch.setFormatter(formatter)
+            _handler = AsyncHandler(ch)
+            _handler.setLevel(LOGGING_LEVEL)
+    return _handler
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands records to a writer thread through a bounded queue, so the
+    caller never waits for formatting or I/O. Messages are formatted by
+    the writer, when the record is written. Records that don't fit in the
+    queue are dropped and reported once the writer catches up.
+    """
+
+    def __init__(self, handler, queue_size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._start()
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self._write, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            # the writer thread doesn't survive a fork
+            self._start()
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Waits until every queued record has been written
+        """
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.join()
+        self.handler.flush()
+
+    def close(self):
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+    def _write(self):
+        reported = 0
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+
+                dropped = self.dropped
+                if dropped != reported:
+                    self.handler.handle(logging.makeLogRecord({
+                        "name": __name__,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": "Dropped %s log records, the writer fell behind",
+                        "args": (dropped - reported,),
+                    }))
+                    reported = dropped
+                self.handler.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                self.queue.task_done()
+
+class JsonFormatter(logging.Formatter):
+    """
+    Writes each record as a JSON object on its own line
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every 1/rate records below WARNING, warnings and errors
+    are always kept
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.every = int(round(1 / rate)) if rate > 0 else 0
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if not self.every:
+            return False
+        return next(self.counter) % self.every == 0
+
+class Truncated(object):
+    """
+    Log argument cut to limit characters, and only converted to text if
+    the record is written
+    """
+
+    def __init__(self, value, limit=LOG_MAX_BODY):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, basestring) else str(self.value)
+        if len(text) > self.limit:
+            text = "%s... (%s more characters)" % (text[:self.limit], len(text) - self.limit)
+        return text.encode("utf-8") if isinstance(text, unicode) else text
@@ -0,0 +1,294 @@
+import atexit
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+import logger
+from config import *
+from mapper import Mapper
+
+class RecordLog(object):
+    """
+    Append-only file of key/value records with an in-memory index of where
+    the latest value of each key is. A record is one line:
+
+        <crc32 of key and value, 8 hex digits> <key> <value>\\n
+
+    Writes only append, and are fsynced in batches every sync_period
+    seconds (on every write with 0), so a crash of the machine loses at
+    most that much. A torn or corrupt record at the end, left by a crash
+    mid-write, is cut off when the log is opened. Corrupt records before
+    the end are skipped and logged, the valid ones after them are kept.
+
+    Superseded records are dropped by compact(), which rewrites the live
+    ones into a new file while writes go on, then swaps it in.
+    """
+
+    def __init__(self, path, sync_period=LOGSTORE_SYNC_PERIOD):
+        self.path = path
+        self.sync_period = sync_period
+        self.index = {}
+        self.live_bytes = 0
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self.logger = logger.get_logger(__name__)
+        self._open()
+
+    def get(self, key):
+        with self._lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            self.file.seek(location[0])
+            return self.file.read(location[1])
+
+    def put(self, key, value):
+        if " " in key or "\n" in value:
+            raise ValueError("Keys can't have spaces nor values line breaks")
+
+        record = "%08x %s %s\n" % (self._checksum(key, value), key, value)
+        with self._lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(record)
+            # in the OS buffers right away, only the fsync is deferred
+            self.file.flush()
+            self._index(key, offset + len(record) - len(value) - 1, len(value), len(record))
+
+            if self.sync_period:
+                self._dirty = True
+            else:
+                os.fsync(self.file.fileno())
+
+    def keys(self):
+        with self._lock:
+            return self.index.keys()
+
+    def size(self):
+        with self._lock:
+            self.file.seek(0, os.SEEK_END)
+            return self.file.tell()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                os.fsync(self.file.fileno())
+                self._dirty = False
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self.file.close()
+
+    def compact(self):
+        """
+        Writes the latest record of every key to a new file and replaces
+        the log with it. The bulk of the copy runs without blocking writes,
+        only the records appended meanwhile are copied with the lock held.
+        """
+        with self._compact_lock:
+            with self._lock:
+                snapshot = dict(self.index)
+                end = self.size()
+
+            tmp_path = self.path + ".compact"
+            index = {}
+            live_bytes = 0
+            with io.open(self.path, "rb") as source:
+                with io.open(tmp_path, "wb") as target:
+                    for key, (offset, length, record_length) in sorted(snapshot.items(), key=lambda i: i[1][0]):
+                        start = offset + length + 1 - record_length
+                        source.seek(start)
+                        record = source.read(record_length)
+                        index[key] = (target.tell() + offset - start, length, record_length)
+                        live_bytes += record_length
+                        target.write(record)
+
+                    with self._lock:
+                        # records appended since the snapshot win over the copied ones
+                        source.seek(end)
+                        tail = source.read()
+                        tail_start = target.tell()
+                        target.write(tail)
+                        target.flush()
+                        os.fsync(target.fileno())
+                        for key, offset, length, record_length in self._scan(tail, tail_start):
+                            if key is None:
+                                continue
+                            previous = index.get(key)
+                            if previous:
+                                live_bytes -= previous[2]
+                            index[key] = (offset, length, record_length)
+                            live_bytes += record_length
+
+                        self.file.close()
+                        os.rename(tmp_path, self.path)
+                        self.file = io.open(self.path, "a+b")
+                        self.index = index
+                        self.live_bytes = live_bytes
+                        self._dirty = False
+
+            self.logger.info("Compacted %s from %s to %s bytes" % (self.path, end + len(tail), live_bytes))
+
+    def needs_compaction(self, ratio=LOGSTORE_COMPACT_RATIO, min_size=LOGSTORE_COMPACT_MIN_SIZE):
+        size = self.size()
+        return size >= min_size and size > ratio * self.live_bytes
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            io.open(self.path, "wb").close()
+
+        with io.open(self.path, "rb") as f:
+            content = f.read()
+
+        valid = 0
+        corrupt = []
+        invalid = [] # lengths of the invalid records since the last valid one
+        for key, offset, length, record_length in self._scan(content, 0):
+            if key is None:
+                invalid.append(record_length)
+                continue
+            # followed by a valid record, so not left by a crash mid-write
+            corrupt.extend(invalid)
+            invalid = []
+            self._index(key, offset, length, record_length)
+            valid = offset + length + 1
+
+        if corrupt:
+            self.logger.error("Skipping %s corrupt records, %s bytes, in %s" % (len(corrupt), sum(corrupt), self.path))
+        if valid < len(content):
+            self.logger.warn("Dropping %s bytes of incomplete records at the end of %s" %
+                             (len(content) - valid, self.path))
+            with io.open(self.path, "r+b") as f:
+                f.truncate(valid)
+                os.fsync(f.fileno())
+
+        self.file = io.open(self.path, "a+b")
+
+    def _scan(self, content, base):
+        """
+        Yields (key, value offset, value length, record length) of each
+        record in content, with a None key and an empty value for invalid
+        ones. A record without its line break ends the scan.
+        """
+        start = 0
+        while start < len(content):
+            end = content.find("\n", start)
+            if end < 0:
+                return
+            try:
+                checksum, key, value = content[start:end].split(" ", 2)
+                valid = int(checksum, 16) == self._checksum(key, value)
+            except ValueError:
+                valid = False
+
+            if valid:
+                yield key, base + end - len(value), len(value), end + 1 - start
+            else:
+                yield None, base + end, 0, end + 1 - start
+            start = end + 1
+
+    def _index(self, key, offset, length, record_length):
+        previous = self.index.get(key)
+        if previous:
+            self.live_bytes -= previous[2]
+        self.index[key] = (offset, length, record_length)
+        self.live_bytes += record_length
+
+    def _checksum(self, key, value):
+        return zlib.crc32("%s %s" % (key, value)) & 0xffffffff
+
+class LogStructuredMapper(Mapper):
+    """
+    Keeps chats and users in a local RecordLog, so each save appends one
+    record instead of rewriting everything. A background thread fsyncs the
+    log and compacts it once superseded records take up most of it.
+    The files written by TextFileMapper are imported on the first start.
+    """
+
+    def __init__(self, db_name, sync_period=LOGSTORE_SYNC_PERIOD, compact_period=LOGSTORE_COMPACT_PERIOD):
+        super(LogStructuredMapper, self).__init__(db_name)
+        self.logger = logger.get_logger(__name__)
+        path = "%s.log" % db_name
+        exists = os.path.exists(path)
+        self.log = RecordLog(path, sync_period)
+        if not exists:
+            self._import_text_files()
+        # serializes the read-modify-writes of membership records
+        self._lock = threading.Lock()
+
+        self.sync_period = sync_period
+        self.compact_period = compact_period
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._maintain, name="logstore")
+        self._thread.daemon = True
+        self._thread.start()
+        # the last writes are synced even if the mapper is never closed
+        atexit.register(self.close)
+
+    def get_chat_by_id(self, id):
+        return self._get("c:%s" % id)
+
+    def get_user_by_id(self, id):
+        return self._get("u:%s" % id)
+
+    def save_chat(self, chat):
+        self.log.put("c:%s" % chat.id, self.codec.encode(chat))
+
+    def save_user(self, user):
+        self.log.put("u:%s" % user.id, self.codec.encode(user))
+
+    def add_membership(self, user_id, chat_id, date):
+        key = "m:%s" % user_id
+        with self._lock:
+            value = self.log.get(key)
+            chats = json.loads(value) if value else {}
+            if chats.get(chat_id, 0) >= date:
+                return
+
+            chats[chat_id] = date
+            self.log.put(key, json.dumps(chats))
+
+    def get_user_chats(self, user_id, limit=DIGEST_MAX_CHATS):
+        value = self.log.get("m:%s" % user_id)
+        chats = json.loads(value) if value else {}
+        return sorted(chats, key=chats.get, reverse=True)[:limit]
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        self.log.close()
+
+    def _get(self, key):
+        value = self.log.get(key)
+        return self.codec.decode(value) if value is not None else None
+
+    def _maintain(self):
+        last_compaction = time.time()
+        while not self._stopped.wait(self.sync_period or 1):
+            try:
+                self.log.sync()
+                if time.time() - last_compaction >= self.compact_period:
+                    last_compaction = time.time()
+                    if self.log.needs_compaction():
+                        self.log.compact()
+            except Exception as e:
+                self.logger.error("Log store maintenance failed: %s" % e)
+
+    def _import_text_files(self):
+        for path, prefix in [(self.db_name, "c"), (USERS_COLLECTION_NAME, "u")]:
+            if not os.path.exists(path):
+                continue
+
+            with open(path) as f:
+                entities = self.codec.decode(f.read())
+            for entity in entities.values():
+                self.log.put("%s:%s" % (prefix, entity.id), self.codec.encode(entity))
+            self.logger.info("Imported %s entries from %s" % (len(entities), path))
+        self.log.sync()
@@ -1,20 +1,161 @@
+import json
+import threading
 import urlparse
+from contextlib import contextmanager
 
-import jsonpickle
-import psycopg2
+from psycopg2.extras import execute_values
 
+import logger
+import metrics
+from chat import Chat
+from codec import get_codec
 from config import *
+from pool import CONNECTION_ERRORS
+from pool import ConnectionPool
 
 CREATE_TABLE = "CREATE TABLE %s (id varchar(20) PRIMARY KEY, value text);"
 
 SELECT_BY_ID = "SELECT * FROM {} WHERE id=%(id)s;"
-INSERT = "INSERT INTO {} VALUES (%(id)s, %(value)s);"
-UPDATE_BY_ID = "UPDATE {} SET value=%(value)s WHERE id=%(id)s;"
+SELECT_BY_ID_FOR_UPDATE = "SELECT * FROM {} WHERE id=%(id)s FOR UPDATE;"
+INSERT_IF_MISSING = "INSERT INTO {} VALUES (%(id)s, %(value)s) ON CONFLICT (id) DO NOTHING;"
+UPSERT = "INSERT INTO {} VALUES (%(id)s, %(value)s) ON CONFLICT (id) DO UPDATE SET value=EXCLUDED.value;"
+SELECT_BY_IDS = "SELECT * FROM {} WHERE id = ANY(%(ids)s);"
+
+CREATE_MEMBERSHIPS = """
+CREATE TABLE IF NOT EXISTS {0} (user_id varchar(20), chat_id varchar(20), last_seen integer NOT NULL,
+    PRIMARY KEY (user_id, chat_id));
+""".format(MEMBERSHIPS_COLLECTION_NAME)
+UPSERT_MEMBERSHIP = """
+INSERT INTO {0} VALUES (%(user_id)s, %(chat_id)s, %(date)s)
+ON CONFLICT (user_id, chat_id) DO UPDATE SET last_seen=GREATEST({0}.last_seen, EXCLUDED.last_seen);
+""".format(MEMBERSHIPS_COLLECTION_NAME)
+# the rows are filled in by execute_values, a (user_id, chat_id) pair may only appear once
+UPSERT_MEMBERSHIPS = """
+INSERT INTO {0} VALUES %s
+ON CONFLICT (user_id, chat_id) DO UPDATE SET last_seen=GREATEST({0}.last_seen, EXCLUDED.last_seen);
+""".format(MEMBERSHIPS_COLLECTION_NAME)
+SELECT_USER_CHATS = """
+SELECT chat_id FROM {0} WHERE user_id=%(user_id)s ORDER BY last_seen DESC LIMIT %(limit)s;
+""".format(MEMBERSHIPS_COLLECTION_NAME)
 
 class Mapper(object):
 
-    def __init__(self, db_name):
+    # whether tags are stored on their own, so they are added, deleted and
+    # paged without loading and saving their whole chat
+    row_tags = False
+
+    def __init__(self, db_name, codec=None):
         self.db_name = db_name
+        self.codec = codec or get_codec()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Scope in which all the mapper operations are applied together.
+        Mappers without transactional storage just run the block.
+        """
+        yield
+
+    def update_chat(self, chat_id, func):
+        """
+        Loads the chat (or a new empty one), passes it to func to be modified
+        and saves it, all within one transaction. func's return value is
+        returned; if it raises, nothing is saved.
+        """
+        with self.transaction():
+            chat = self.get_chat_by_id(chat_id) or Chat(chat_id)
+            result = func(chat)
+            self.save_chat(chat)
+            return result
+
+    def get_chats(self, chat_ids):
+        """
+        Returns a dict of the chats with the given IDs, missing ones are
+        left out
+        """
+        chats = {}
+        for chat_id in chat_ids:
+            chat = self.get_chat_by_id(chat_id)
+            if chat:
+                chats[chat.id] = chat
+        return chats
+
+    def add_membership(self, user_id, chat_id, date):
+        """
+        Records that the user interacted with the chat at date
+        """
+        raise NotImplementedError()
+
+    def add_memberships(self, memberships):
+        """
+        Records a list of (user ID, chat ID, date) memberships
+        """
+        for user_id, chat_id, date in memberships:
+            self.add_membership(user_id, chat_id, date)
+
+    def get_user_chats(self, user_id, limit=DIGEST_MAX_CHATS):
+        """
+        Returns the IDs of the chats the user interacted with, most recent
+        first
+        """
+        raise NotImplementedError()
+
+    def get_tags(self, chat_id):
+        """
+        Returns the tags of a chat, oldest first
+        """
+        chat = self.get_chat_by_id(chat_id)
+        return chat.tags if chat else []
+
+    def get_tags_page(self, chat_id, skip, limit):
+        """
+        Returns up to limit tags of a chat, oldest first, leaving out its
+        skip most recent ones, and how many tags the chat has in total
+        """
+        tags = self.get_tags(chat_id)
+        end = max(len(tags) - skip, 0)
+        return tags[max(end - limit, 0):end], len(tags)
+
+    def add_tag(self, chat_id, tag, max_tags=MAX_TAGS):
+        """
+        Appends the tag to the chat, dropping the oldest ones so it keeps at
+        most its retention, max_tags unless the chat set its own
+        """
+        def add(chat):
+            chat.tags.append(tag)
+            del chat.tags[:-chat.retention(max_tags)]
+
+        self.update_chat(chat_id, add)
+
+    def get_retention(self, chat_id):
+        """
+        Returns how many tags the chat keeps
+        """
+        chat = self.get_chat_by_id(chat_id)
+        return chat.retention() if chat else MAX_TAGS
+
+    def set_max_tags(self, chat_id, max_tags):
+        """
+        Sets how many tags the chat keeps, dropping the oldest ones beyond it
+        """
+        def update(chat):
+            chat.max_tags = max_tags
+            del chat.tags[:-max_tags]
+
+        self.update_chat(chat_id, update)
+
+    def delete_tag(self, chat_id, tag):
+        def delete(chat):
+            keys = [t.key() for t in chat.tags]
+            if tag.key() in keys:
+                chat.tags.pop(keys.index(tag.key()))
+
+        self.update_chat(chat_id, delete)
+
+    def close(self):
+        """
+        Releases the storage, pending writes are made durable first
+        """
 
 class TextFileMapper(Mapper):
 
@@ -23,7 +164,7 @@ class TextFileMapper(Mapper):
         self.chats = {}
         try:
             f = open(self.db_name)
-            self.chats = jsonpickle.decode(f.read())
+            self.chats = self.codec.decode(f.read())
             f.close()
         except:
             pass
@@ -31,7 +172,15 @@ class TextFileMapper(Mapper):
         self.users = {}
         try:
             f = open(USERS_COLLECTION_NAME)
-            self.users = jsonpickle.decode(f.read())
+            self.users = self.codec.decode(f.read())
+            f.close()
+        except:
+            pass
+
+        self.memberships = {}
+        try:
+            f = open(MEMBERSHIPS_COLLECTION_NAME)
+            self.memberships = json.loads(f.read())
             f.close()
         except:
             pass
@@ -45,30 +194,86 @@ class TextFileMapper(Mapper):
     def save_chat(self, chat):
         self.chats[chat.id] = chat
         f = open(self.db_name, "w")
-        f.write(jsonpickle.encode(self.chats))
+        f.write(self.codec.encode(self.chats))
         f.close()
 
     def save_user(self, user):
         self.users[user.id] = user
         f = open(USERS_COLLECTION_NAME, "w")
-        f.write(jsonpickle.encode(self.users))
+        f.write(self.codec.encode(self.users))
         f.close()
 
-def db_operation(func):
+    def add_membership(self, user_id, chat_id, date):
+        self.add_memberships([(user_id, chat_id, date)])
+
+    def add_memberships(self, memberships):
+        changed = False
+        for user_id, chat_id, date in memberships:
+            chats = self.memberships.setdefault(user_id, {})
+            if chats.get(chat_id, 0) < date:
+                chats[chat_id] = date
+                changed = True
+        if not changed:
+            return
+
+        f = open(MEMBERSHIPS_COLLECTION_NAME, "w")
+        f.write(json.dumps(self.memberships))
+        f.close()
+
+    def get_user_chats(self, user_id, limit=DIGEST_MAX_CHATS):
+        chats = self.memberships.get(user_id, {})
+        return sorted(chats, key=chats.get, reverse=True)[:limit]
+
+_current = threading.local()
+
+def mapper_operation(func):
+    """
+    Labels the metrics of the database operations run by func, and by the
+    methods it calls, with func's name
+    """
+    name = func.__name__
+
     def inner(self, *args, **kwargs):
-        opened_conn = bool(not self.connection or self.connection.closed)
-        self.connection = self.connect()
-        self.cursor = self.connection.cursor()
+        if getattr(_current, "operation", None) is not None:
+            return func(self, *args, **kwargs)
+
+        _current.operation = name
         try:
             return func(self, *args, **kwargs)
-        except psycopg2.DatabaseError as e:
-            raise e
         finally:
-            # don't close a connection you didn't open
-            if self.connection and opened_conn:
-                self.connection.commit()
-                self.connection.close()
-                self.connection = None
+            _current.operation = None
+
+    return inner
+
+def db_operation(func):
+    """
+    Runs the operation with a cursor from the current transaction, opening
+    one if there is none. Operations outside of an explicit transaction are
+    retried on a fresh connection if the pooled one turns out to be broken.
+    """
+    default_operation = func.__name__.lstrip("_")
+
+    def inner(self, *args, **kwargs):
+        operation = getattr(_current, "operation", None) or default_operation
+        retries = 0 if self.pool.in_transaction() else DB_RECONNECT_RETRIES
+        with metrics.DB_SECONDS.time(operation=operation):
+            while True:
+                try:
+                    with self.pool.transaction() as conn:
+                        cursor = conn.cursor()
+                        try:
+                            return func(self, cursor, *args, **kwargs)
+                        finally:
+                            cursor.close()
+                except CONNECTION_ERRORS as e:
+                    if retries <= 0:
+                        metrics.DB_ERRORS.inc(operation=operation)
+                        raise
+                    retries -= 1
+                    self.logger.warn("Database connection lost, reconnecting: %s" % e)
+                except Exception:
+                    metrics.DB_ERRORS.inc(operation=operation)
+                    raise
 
     return inner
 
@@ -77,21 +282,16 @@ class PostgreSQLMapper(Mapper):
     def __init__(self, db_name):
         super(PostgreSQLMapper, self).__init__(db_name)
         self.url = urlparse.urlparse(DATABASE_URL)
-        self.connection = None
+        self.pool = ConnectionPool(self.url)
+        self.logger = logger.get_logger(__name__)
 
         self.provision_db()
 
-    def connect(self):
-        if self.connection and not self.connection.closed: return self.connection
-        conn = psycopg2.connect(
-            database=self.url.path[1:],
-            user=self.url.username,
-            password=self.url.password,
-            host=self.url.hostname,
-            port=self.url.port
-        )
-        self.connection = conn
-        return conn
+    def transaction(self):
+        return self.pool.transaction()
+
+    def close(self):
+        self.pool.close()
 
     def provision_db(self):
         try:
@@ -99,6 +299,7 @@ class PostgreSQLMapper(Mapper):
             self.create_table(USERS_COLLECTION_NAME)
         except:
             pass # ignore errors
+        self._create_memberships()
 
         # ensure that we have the tables
         self.get_chat_by_id("dummy")
@@ -109,47 +310,110 @@ class PostgreSQLMapper(Mapper):
         if not res:
             return None
 
-        return jsonpickle.decode(res[1])
+        return self.codec.decode(res[1])
 
     def save_chat(self, chat):
-        blob = jsonpickle.encode(chat)
-        if self.get_chat_by_id(chat.id): # update chat if it already exists
-            self._update_by_id(CHATS_COLLECTION_NAME, {'id': chat.id, 'value': blob})
-        else:
-            self._insert(CHATS_COLLECTION_NAME, {'id': chat.id, 'value': blob})
+        blob = self.codec.encode(chat)
+        self._upsert(CHATS_COLLECTION_NAME, {'id': chat.id, 'value': blob})
+
+    def update_chat(self, chat_id, func):
+        with self.transaction():
+            chat = self._get_chat_for_update(chat_id)
+            result = func(chat)
+            self.save_chat(chat)
+            return result
+
+    def get_chats(self, chat_ids):
+        rows = self._select_by_ids(CHATS_COLLECTION_NAME, {'ids': list(chat_ids)})
+        return dict((row[0], self.codec.decode(row[1])) for row in rows)
+
+    def add_membership(self, user_id, chat_id, date):
+        self._upsert_membership({'user_id': user_id, 'chat_id': chat_id, 'date': date})
+
+    def add_memberships(self, memberships):
+        latest = {}
+        for user_id, chat_id, date in memberships:
+            key = (user_id, chat_id)
+            latest[key] = max(latest.get(key, 0), date)
+        if latest:
+            self._upsert_memberships([(u, c, d) for (u, c), d in latest.items()])
+
+    def get_user_chats(self, user_id, limit=DIGEST_MAX_CHATS):
+        return [row[0] for row in self._select_user_chats({'user_id': user_id, 'limit': limit})]
 
     def get_user_by_id(self, id):
         res = self._select_by_id(USERS_COLLECTION_NAME, {'id': id })
         if not res:
             return None
 
-        return jsonpickle.decode(res[1])
+        return self.codec.decode(res[1])
 
     def save_user(self, user):
-        blob = jsonpickle.encode(user)
-        if self.get_user_by_id(user.id): # update user if it already exists
-            self._update_by_id(USERS_COLLECTION_NAME, {'id': user.id, 'value': blob})
-        else:
-            self._insert(USERS_COLLECTION_NAME, {'id': user.id, 'value': blob})
+        blob = self.codec.encode(user)
+        self._upsert(USERS_COLLECTION_NAME, {'id': user.id, 'value': blob})
+
+    def _get_chat_for_update(self, chat_id):
+        """
+        Returns the chat with its row locked until the transaction ends.
+        A missing chat is inserted first so there is a row to lock and
+        concurrent writers of a new chat are serialized too.
+        """
+        values = {'id': chat_id}
+        res = self._select_by_id_for_update(CHATS_COLLECTION_NAME, values)
+        if not res:
+            values['value'] = self.codec.encode(Chat(chat_id))
+            self._insert_if_missing(CHATS_COLLECTION_NAME, values)
+            res = self._select_by_id_for_update(CHATS_COLLECTION_NAME, values)
+
+        return self.codec.decode(res[1])
 
     @db_operation
-    def _select_by_id(self, table, values):
+    def _select_by_id(self, cursor, table, values):
         statement = SELECT_BY_ID.format(table)
-        self.cursor.execute(statement, values)
-        return self.cursor.fetchone()
+        cursor.execute(statement, values)
+        return cursor.fetchone()
+
+    @db_operation
+    def _select_by_ids(self, cursor, table, values):
+        statement = SELECT_BY_IDS.format(table)
+        cursor.execute(statement, values)
+        return cursor.fetchall()
+
+    @db_operation
+    def _select_by_id_for_update(self, cursor, table, values):
+        statement = SELECT_BY_ID_FOR_UPDATE.format(table)
+        cursor.execute(statement, values)
+        return cursor.fetchone()
+
+    @db_operation
+    def _insert_if_missing(self, cursor, table, values):
+        statement = INSERT_IF_MISSING.format(table)
+        cursor.execute(statement, values)
+
+    @db_operation
+    def _upsert(self, cursor, table, values):
+        statement = UPSERT.format(table)
+        cursor.execute(statement, values)
+
+    @db_operation
+    def _upsert_membership(self, cursor, values):
+        cursor.execute(UPSERT_MEMBERSHIP, values)
+
+    @db_operation
+    def _upsert_memberships(self, cursor, rows):
+        # executemany would make a round trip per row
+        execute_values(cursor, UPSERT_MEMBERSHIPS, rows, page_size=len(rows))
 
     @db_operation
-    def _insert(self, table, values):
-        statement = INSERT.format(table)
-        self.cursor.execute(statement, values)
+    def _select_user_chats(self, cursor, values):
+        cursor.execute(SELECT_USER_CHATS, values)
+        return cursor.fetchall()
 
     @db_operation
-    def _update_by_id(self, table, values):
-        statement = UPDATE_BY_ID.format(table)
-        self.cursor.execute(statement, values)
+    def _create_memberships(self, cursor):
+        cursor.execute(CREATE_MEMBERSHIPS)
 
     @db_operation
-    def create_table(self, table):
+    def create_table(self, cursor, table):
         statement = CREATE_TABLE % table
-        self.cursor.execute(statement)
-        self.connection.commit()
+        cursor.execute(statement)
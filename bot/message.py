@@ -1,17 +1,20 @@
 import user
 
-def message_from_json(j):
+def message_from_json(j, update_id=None):
     id = j["message_id"]
     u = user.user_from_json(j["from"])
     date = j["date"]
     chat_id = j["chat"]["id"]
     text = j.get("text", "")
-    return Message(id, u, date, chat_id, text)
+    return Message(id, u, date, chat_id, text, update_id)
 
 class Message(object):
-    def __init__(self, id, user, date, chat_id, text=""):
+    __slots__ = ("id", "user", "date", "chat_id", "text", "update_id")
+
+    def __init__(self, id, user, date, chat_id, text="", update_id=None):
         self.id = id
         self.user = user
         self.date = date
         self.chat_id = str(chat_id)
         self.text = text
+        self.update_id = update_id
@@ -0,0 +1,158 @@
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+class Counter(object):
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def drain(self):
+        """
+        Returns the values counted since the last drain and starts over
+        """
+        with self._lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self._lock:
+            for key, amount in values.items():
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(labels), value))
+        return lines
+
+class Histogram(object):
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                # per bucket counts, then sum and count
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def drain(self):
+        """
+        Returns the series observed since the last drain and starts over
+        """
+        with self._lock:
+            series, self.series = self.series, {}
+        return series
+
+    def merge(self, series):
+        with self._lock:
+            for key, values in series.items():
+                current = self.series.get(key)
+                self.series[key] = [a + b for a, b in zip(current, values)] if current else list(values)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for labels, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append("%s_bucket%s %s" % (self.name, format_labels(labels + (("le", bound),)), count))
+                lines.append("%s_bucket%s %s" % (self.name, format_labels(labels + (("le", "+Inf"),)), series[-1]))
+                lines.append("%s_sum%s %r" % (self.name, format_labels(labels), series[-2]))
+                lines.append("%s_count%s %s" % (self.name, format_labels(labels), series[-1]))
+        return lines
+
+class Gauge(object):
+    """
+    Reads its values when rendered, func returns a list of (labels, value).
+    Also exposes counters kept elsewhere, with type="counter".
+    """
+
+    def __init__(self, name, help, func, type="gauge"):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for labels, value in self.func():
+            lines.append("%s%s %s" % (self.name, format_labels(tuple(sorted(labels.items()))), value))
+        return lines
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        # registering a name again replaces the previous metric
+        self.metrics[metric.name] = metric
+        return metric
+
+    def drain(self):
+        """
+        Returns what the counters and histograms recorded since the last
+        drain, for another process to merge into its registry
+        """
+        return dict((name, metric.drain()) for name, metric in self.metrics.items() if hasattr(metric, "drain"))
+
+    def merge(self, drained):
+        for name, values in drained.items():
+            if name in self.metrics:
+                self.metrics[name].merge(values)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+MESSAGE_SECONDS = REGISTRY.add(Histogram("ehbot_message_seconds", "Time handling a message, by command."))
+MESSAGES_IGNORED = REGISTRY.add(Counter("ehbot_messages_ignored_total", "Messages that are not for the bot."))
+UPDATES_DUPLICATE = REGISTRY.add(Counter("ehbot_updates_duplicate_total", "Updates dropped as already handled."))
+UPDATES_DROPPED = REGISTRY.add(Counter("ehbot_updates_dropped_total", "Updates dropped as their data can't be stored."))
+DB_SECONDS = REGISTRY.add(Histogram("ehbot_db_operation_seconds", "Time of each database operation."))
+DB_ERRORS = REGISTRY.add(Counter("ehbot_db_errors_total", "Failed database operations."))
+API_SECONDS = REGISTRY.add(Histogram("ehbot_api_request_seconds", "Time of each Bot API request."))
+API_ERRORS = REGISTRY.add(Counter("ehbot_api_errors_total", "Bot API requests that failed to get a response."))
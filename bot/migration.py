@@ -1,35 +1,214 @@
+"""
+Loads the legacy chats file, a JSON object of chat IDs to lists of
+Telegram messages, into PostgreSQL.
+
+The file is parsed one chat at a time and loaded in batches with COPY.
+The offset in the file reached by each batch is saved in the same
+transaction as its rows, so an interrupted run resumes right after the
+last batch that was committed. Runs in the background of the bot when
+PENDING_MIGRATION is set, or on its own:
+
+    python bot/migration.py [legacy chats file]
+"""
+import io
 import json
-import jsonpickle
+import sys
+import threading
+import time
 
+import logger
 from chat import Chat
 from tag import Tag
 from user import User
 from config import *
+from offset import PostgreSQLOffsetStore
+from relational import RelationalMapper
+
+LEGACY_ADMIN = 58699815
+CHECKPOINT_KEY = "legacy_migration"
+
+CREATE_STAGING = [
+    "CREATE TEMP TABLE migration_chats (id varchar(20), value text) ON COMMIT DROP;",
+    "CREATE TEMP TABLE migration_users (id varchar(20), first_name text, last_name text, username text, value text) ON COMMIT DROP;",
+    "CREATE TEMP TABLE migration_tags (chat_id varchar(20), user_id varchar(20), text text, date integer) ON COMMIT DROP;",
+]
+# whatever the bot wrote since the migration started is kept
+LOAD_BLOBS = [
+    "INSERT INTO {chats} SELECT DISTINCT ON (id) id, value FROM migration_chats ON CONFLICT (id) DO NOTHING;",
+    "INSERT INTO {users} SELECT DISTINCT ON (id) id, value FROM migration_users ON CONFLICT (id) DO NOTHING;",
+]
+LOAD_RELATIONAL = [
+    "INSERT INTO {chats} (id, admin) SELECT DISTINCT ON (id) id, value FROM migration_chats ON CONFLICT (id) DO NOTHING;",
+    """INSERT INTO {users} (id, first_name, last_name, username)
+       SELECT DISTINCT ON (id) id, first_name, last_name, username FROM migration_users ON CONFLICT (id) DO NOTHING;""",
+    "INSERT INTO {tags} (chat_id, user_id, text, date) SELECT chat_id, user_id, text, date FROM migration_tags;",
+]
+
+def iter_legacy_chats(f, start=0, chunk_size=MIGRATION_CHUNK_SIZE):
+    """
+    Yields (chat ID, list of message JSON, offset after the chat) for each
+    chat in the file, reading chunk_size bytes at a time. A start offset
+    previously yielded resumes right after that chat.
+    """
+    decoder = json.JSONDecoder()
+    f.seek(start)
+    buf = f.read(chunk_size)
+    base = start
+    pos = 0
+    eof = not buf
+
+    def skip(pos, chars):
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        return pos
+
+    if start == 0:
+        pos = skip(pos, " \t\r\n")
+        if buf[pos:pos + 1] != "{":
+            raise InvalidLegacyFileException("The legacy file is not a JSON object")
+        pos += 1
+
+    while True:
+        pos = skip(pos, " \t\r\n,")
+        if buf[pos:pos + 1] == "}":
+            return
+
+        try:
+            key, value_start = decoder.raw_decode(buf, pos)
+            value_start = skip(value_start, " \t\r\n:")
+            value, end = decoder.raw_decode(buf, value_start)
+        except ValueError:
+            if eof:
+                raise InvalidLegacyFileException("Unexpected content at offset %s" % (base + pos))
+            # the chat continues in the next chunk
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            base += pos
+            pos = 0
+            continue
+
+        yield key, value, base + end
+        pos = end
+
+def copy_line(*values):
+    """
+    Formats a row for COPY's text format
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append("\\N")
+            continue
+        if not isinstance(value, unicode):
+            value = unicode(value)
+        value = value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+        fields.append(value.encode("utf-8"))
+    return "\t".join(fields) + "\n"
+
+class Migration(object):
+    """
+    Copies the chats of the legacy file into the tables of the mapper,
+    the relational ones or the blob ones depending on its class
+    """
+
+    def __init__(self, mapper, path=LEGACY_CHATS_FILE, batch_size=MIGRATION_BATCH_SIZE):
+        self.mapper = mapper
+        self.path = path
+        self.batch_size = batch_size
+        self.relational = isinstance(mapper, RelationalMapper)
+        self.checkpoint = PostgreSQLOffsetStore(mapper.pool, CHECKPOINT_KEY)
+        self.logger = logger.get_logger(__name__)
+
+    def run(self):
+        start = self.checkpoint.load()
+        if start:
+            self.logger.info("Resuming the migration of %s from offset %s" % (self.path, start))
+
+        chats = rows = 0
+        began = time.time()
+        batch = []
+        with io.open(self.path, "rb") as f:
+            for chat_id, messages, offset in iter_legacy_chats(f, start):
+                batch.append((chat_id, messages))
+                if len(batch) >= self.batch_size:
+                    rows += self.load(batch, offset)
+                    chats += len(batch)
+                    batch = []
+                    self._report(chats, rows, began)
+
+        if batch:
+            rows += self.load(batch, offset)
+            chats += len(batch)
+
+        self._report(chats, rows, began, done=True)
+
+    def load(self, batch, offset):
+        """
+        Writes a batch of chats and the offset after them in one
+        transaction, returns how many rows were copied
+        """
+        chats, users, tags = io.BytesIO(), io.BytesIO(), io.BytesIO()
+        count = 0
+        for chat_id, messages in batch:
+            chat = Chat(chat_id, tags=[self._tag(m) for m in messages], admin=LEGACY_ADMIN)
+            value = LEGACY_ADMIN if self.relational else self.mapper.codec.encode(chat)
+            chats.write(copy_line(chat.id, value))
+            for tag in chat.tags:
+                user = tag.user
+                value = None if self.relational else self.mapper.codec.encode(user)
+                users.write(copy_line(user.id, user.first_name, user.last_name, user.username, value))
+                tags.write(copy_line(chat.id, user.id, tag.text, tag.date))
+            count += 1 + 2 * len(chat.tags)
+
+        tables = {"chats": CHATS_COLLECTION_NAME, "users": USERS_COLLECTION_NAME, "tags": TAGS_COLLECTION_NAME}
+        with self.mapper.pool.transaction() as conn:
+            cursor = conn.cursor()
+            for statement in CREATE_STAGING:
+                cursor.execute(statement)
+            for name, buf in [("migration_chats", chats), ("migration_users", users), ("migration_tags", tags)]:
+                buf.seek(0)
+                cursor.copy_from(buf, name, null="\\N")
+            for statement in LOAD_RELATIONAL if self.relational else LOAD_BLOBS:
+                cursor.execute(statement.format(**tables))
+            cursor.close()
+            self.checkpoint.save(offset)
+
+        return count
 
+    def _tag(self, message):
+        user_json = message["from"]
+        user = User(user_json["id"], user_json.get("first_name", ""), user_json.get("last_name", ""),
+                    user_json.get("username", ""))
+        return Tag(message["text"], user, message["date"])
 
-def do():
-    f = open(CHATS_COLLECTION_NAME)
-    tags = json.loads(f.read())
-    f.close()
+    def _report(self, chats, rows, began, done=False):
+        elapsed = max(time.time() - began, 1e-6)
+        self.logger.info("%s %s chats, %s rows in %.1fs (%.0f rows/s)" % (
+            "Migrated" if done else "Migrating:", chats, rows, elapsed, rows / elapsed))
 
-    chats_by_id = {}
-    for id, tags_json in tags.items():
-        tags = []
-        for j in tags_json:
-            user_json = j["from"]
-            first_name = user_json.get("first_name", "")
-            last_name = user_json.get("last_name", "")
-            username = user_json.get("username", "")
-            user = User(user_json["id"], first_name, last_name, username)
-            tag = Tag(j["text"], user, j["date"])
-            tags.append(tag)
+def start(mapper, path=LEGACY_CHATS_FILE):
+    """
+    Runs the migration in a background thread
+    """
+    def run():
+        try:
+            Migration(mapper, path).run()
+        except Exception as e:
+            logger.get_logger(__name__).error("Legacy migration stopped, it resumes on the next start: %s" % e)
 
-        admin = 58699815
-        chats_by_id[id] = Chat(id, tags=tags, admin=admin)
+    thread = threading.Thread(target=run, name="migration")
+    thread.daemon = True
+    thread.start()
+    return thread
 
-    encoded = jsonpickle.encode(chats_by_id)
+class InvalidLegacyFileException(Exception):
+    pass
 
-    f = open(CHATS_COLLECTION_NAME, "w")
-    f.write(encoded)
-    f.close()
+if __name__ == "__main__":
+    from mapper import PostgreSQLMapper
 
+    mapper_class = RelationalMapper if STORAGE_BACKEND == "relational" else PostgreSQLMapper
+    mapper = mapper_class(CHATS_COLLECTION_NAME)
+    Migration(mapper, sys.argv[1] if len(sys.argv) > 1 else LEGACY_CHATS_FILE).run()
+    mapper.close()
@@ -0,0 +1,124 @@
+import os
+import time
+
+import logger
+from config import *
+from statefile import write_atomically
+
+CREATE_STATE_TABLE = "CREATE TABLE IF NOT EXISTS bot_state (key varchar(50) PRIMARY KEY, value bigint NOT NULL);"
+SELECT_STATE = "SELECT value FROM bot_state WHERE key=%(key)s;"
+UPSERT_STATE = """
+INSERT INTO bot_state (key, value) VALUES (%(key)s, %(value)s)
+ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value;
+"""
+
+class OffsetStore(object):
+    """
+    Persists the offset of the next update to fetch from Telegram
+    """
+
+    def load(self):
+        raise NotImplementedError()
+
+    def save(self, offset):
+        raise NotImplementedError()
+
+class FileOffsetStore(OffsetStore):
+
+    def __init__(self, path=LAST_UPDATE_ID_FILE):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+
+        with open(self.path) as f:
+            content = f.read().split('\n')[0]
+        try:
+            return int(content)
+        except ValueError:
+            # refuse to guess, starting from 0 would replay every pending update
+            raise CorruptOffsetException("Invalid offset in %s: %r" % (self.path, content))
+
+    def save(self, offset):
+        write_atomically(self.path, str(offset))
+
+class PostgreSQLOffsetStore(OffsetStore):
+    """
+    Keeps the offset in the database. Saved inside a transaction it is
+    committed together with the writes of the batch it belongs to.
+    """
+
+    def __init__(self, pool, key="last_update_id"):
+        self.pool = pool
+        self.key = key
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(CREATE_STATE_TABLE)
+            cursor.close()
+
+    def load(self):
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_STATE, {'key': self.key})
+            row = cursor.fetchone()
+            cursor.close()
+        return row[0] if row else 0
+
+    def save(self, offset):
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(UPSERT_STATE, {'key': self.key, 'value': offset})
+            cursor.close()
+
+class Checkpointer(object):
+    """
+    Tracks the update offset and coalesces saving it: the store is only
+    written every `every` advances or `period` seconds, and on flush().
+    After a crash the updates since the last checkpoint are fetched again.
+    """
+
+    def __init__(self, store, every=OFFSET_CHECKPOINT_EVERY, period=OFFSET_CHECKPOINT_PERIOD):
+        self.store = store
+        self.every = every
+        self.period = period
+        self.offset = 0
+        self.logger = logger.get_logger(__name__)
+        self._pending = 0
+        self._last_save = time.time()
+
+    def load(self):
+        self.offset = self.store.load()
+        self.logger.info("Starting from update offset %s" % self.offset)
+        return self.offset
+
+    def advance(self, offset, save=False):
+        """
+        Moves the offset forward, saving it right away with save. The
+        offset must only be advanced past updates whose writes committed,
+        unless the store saves it in their transaction.
+        """
+        if offset <= self.offset:
+            return
+
+        self.offset = offset
+        self._pending += 1
+        if save or self._pending >= self.every or time.time() - self._last_save >= self.period:
+            self.flush()
+
+    def rewind(self, offset):
+        """
+        Goes back to offset after the updates past it were rolled back
+        """
+        self.offset = offset
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        self.store.save(self.offset)
+        self._pending = 0
+        self._last_save = time.time()
+
+class CorruptOffsetException(Exception):
+    pass
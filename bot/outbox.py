@@ -0,0 +1,280 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+
+import logger
+from config import *
+from render import split_message
+from requester import SendMessageRequest
+from workers import ShardedWorkerPool
+
+class TokenBucket(object):
+    """
+    Allows rate operations per second on average with bursts of up to
+    capacity operations
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how many seconds to wait before using it
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        with self._lock:
+            return self.tokens + (time.time() - self.last) * self.rate >= self.capacity
+
+def coalesce(texts, limit=MAX_MESSAGE_LENGTH):
+    """
+    Drops repeated texts and joins the rest, in order, into as few
+    messages of at most limit characters as possible. Texts too long for
+    one message are split first.
+    """
+    messages = []
+    seen = set()
+    for text in texts:
+        if text in seen:
+            continue
+        seen.add(text)
+
+        for part in split_message(text, limit):
+            if messages and len(messages[-1]) + 2 + len(part) <= limit:
+                messages[-1] += "\n\n" + part
+            else:
+                messages.append(part)
+    return messages
+
+class OutboundMessage(object):
+
+    def __init__(self, chat_id, text, queued_at=None):
+        self.chat_id = str(chat_id)
+        self.text = text
+        self.queued_at = queued_at or time.time()
+
+class Outbox(object):
+    """
+    Sends messages from a pool of background workers, within the Bot API
+    limits: OUTBOX_GLOBAL_RATE messages per second overall, OUTBOX_CHAT_RATE
+    to the same user and OUTBOX_GROUP_RATE to the same group.
+    Messages to one chat are sent in order. Throttled (429) and failed
+    sends are retried, waiting the retry_after Telegram asks for.
+    With no workers, messages are sent right away on the calling thread.
+
+    Replies to the same chat within coalesce_window seconds, or before
+    release() is called at the end of a batch, are merged into as few
+    messages as possible. Replies sent within hold() wait for the scope
+    to succeed.
+    """
+
+    def __init__(self, workers=OUTBOX_WORKERS, queue_size=OUTBOX_QUEUE_SIZE, global_rate=OUTBOX_GLOBAL_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, group_rate=OUTBOX_GROUP_RATE, coalesce_window=OUTBOX_COALESCE_WINDOW):
+        self.logger = logger.get_logger(__name__)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self._buckets_lock = threading.Lock()
+
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._stats_lock = threading.Lock()
+
+        self.pool = None
+        if workers > 0:
+            self.pool = ShardedWorkerPool(self.deliver, workers, queue_size, "outbox")
+
+        self.coalesce_window = coalesce_window
+        self._pending = OrderedDict() # chat ID -> (time of the first reply, texts)
+        self._pending_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._local = threading.local()
+        self._coalescer = None
+        if coalesce_window > 0:
+            self._coalescer = threading.Thread(target=self._release_expired, name="outbox-coalescer")
+            self._coalescer.daemon = True
+            self._coalescer.start()
+            # the thread must not be waiting when the interpreter shuts down
+            atexit.register(self._stop_coalescer)
+
+    def send(self, chat_id, text):
+        held = getattr(self._local, "held", None)
+        if held is not None:
+            held.append((chat_id, text))
+            return
+
+        if self.coalesce_window <= 0:
+            for part in split_message(text):
+                self._enqueue(OutboundMessage(chat_id, part))
+            return
+
+        with self._pending_lock:
+            pending = self._pending.get(str(chat_id))
+            if pending is None:
+                pending = self._pending[str(chat_id)] = (time.time(), [])
+            pending[1].append(text)
+
+    @contextmanager
+    def hold(self):
+        """
+        Keeps aside the replies this thread sends within the scope and
+        sends them once it ends, or drops them if it raises: the replies of
+        a batch that is rolled back go out when its retry succeeds
+        """
+        if getattr(self._local, "held", None) is not None:
+            yield
+            return
+
+        held = self._local.held = []
+        try:
+            yield
+        except:
+            if held:
+                self.logger.warn("Dropping %s replies of updates that failed" % len(held))
+            raise
+        finally:
+            self._local.held = None
+
+        for chat_id, text in held:
+            self.send(chat_id, text)
+
+    def release(self, older_than=0):
+        """
+        Merges and queues the replies waiting for more replies to the same
+        chat, those that have waited at least older_than seconds
+        """
+        now = time.time()
+        with self._pending_lock:
+            ready = [(c, p) for c, p in self._pending.items() if now - p[0] >= older_than]
+            for chat_id, _ in ready:
+                del self._pending[chat_id]
+
+        for chat_id, (since, texts) in ready:
+            messages = coalesce(texts)
+            with self._stats_lock:
+                # against one call per part of every text
+                self.coalesced += sum(len(split_message(t)) for t in texts) - len(messages)
+            for text in messages:
+                self._enqueue(OutboundMessage(chat_id, text, since))
+
+    def flush(self):
+        """
+        Waits until every queued message has been sent
+        """
+        self.release()
+        if self.pool:
+            self.pool.join()
+
+    def stop(self):
+        self._stop_coalescer()
+        self.release()
+        if self.pool:
+            self.pool.stop()
+
+    def _enqueue(self, message):
+        if self.pool:
+            # blocks while the chat's queue is full
+            self.pool.submit(message.chat_id, message)
+        else:
+            self.deliver(message)
+
+    def _stop_coalescer(self):
+        self._stopping.set()
+        if self._coalescer:
+            self._coalescer.join()
+
+    def _release_expired(self):
+        while not self._stopping.wait(self.coalesce_window / 2):
+            try:
+                self.release(self.coalesce_window)
+            except Exception as e:
+                self.logger.error("Failed to release coalesced replies: %s" % e)
+
+    def stats(self):
+        with self._stats_lock:
+            sent = self.sent
+            return {
+                "queue_depth": self.pool.depth() if self.pool else 0,
+                "sent": sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "coalesced": self.coalesced,
+                "latency_avg": self.latency_total / sent if sent else 0.0,
+                "latency_max": self.latency_max,
+            }
+
+    def deliver(self, message):
+        delay = OUTBOX_RETRY_BACKOFF
+        for attempt in range(OUTBOX_MAX_ATTEMPTS):
+            if attempt:
+                with self._stats_lock:
+                    self.retries += 1
+
+            time.sleep(max(self._chat_bucket(message.chat_id).reserve(), self.global_bucket.reserve()))
+            try:
+                response, content = SendMessageRequest(message.chat_id, message.text).do()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.logger.warn("Failed to send message to %s: %s" % (message.chat_id, e))
+                time.sleep(delay)
+                delay *= 2
+                continue
+
+            if response.status_code == 200 and content.get("ok"):
+                self._record_sent(message)
+                return
+
+            if response.status_code == 429:
+                retry_after = content.get("parameters", {}).get("retry_after", delay)
+                self.logger.warn("Throttled sending to %s, retrying in %ss" % (message.chat_id, retry_after))
+                time.sleep(retry_after)
+            elif response.status_code >= 500:
+                time.sleep(delay)
+                delay *= 2
+            else:
+                # the request itself is wrong (e.g. the user blocked the bot), retrying won't help
+                break
+
+        with self._stats_lock:
+            self.failed += 1
+        self.logger.error("Gave up sending message to %s" % message.chat_id)
+
+    def _record_sent(self, message):
+        latency = time.time() - message.queued_at
+        with self._stats_lock:
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def _chat_bucket(self, chat_id):
+        with self._buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) >= OUTBOX_MAX_BUCKETS:
+                    # idle chats are back at full capacity, their buckets can be recreated
+                    for id in [i for i, b in self.chat_buckets.items() if b.is_full()]:
+                        del self.chat_buckets[id]
+
+                # group chat IDs are negative
+                rate = self.group_rate if chat_id.startswith("-") else self.chat_rate
+                bucket = TokenBucket(rate)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
@@ -0,0 +1,127 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+
+import logger
+from config import *
+
+# errors that mean the connection itself is unusable and has to be replaced
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# errors caused by the values written, writing them again fails the same way
+DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of PostgreSQL connections.
+
+    Connections are checked out for the duration of a transaction scope and
+    bound to the calling thread, so every operation issued inside the scope
+    runs on the same connection and commits (or rolls back) together.
+    """
+
+    def __init__(self, url, minconn=DB_POOL_MIN_CONN, maxconn=DB_POOL_MAX_CONN,
+                 check_interval=DB_POOL_CHECK_INTERVAL):
+        self.url = url
+        self.check_interval = check_interval
+        self.logger = logger.get_logger(__name__)
+
+        # ThreadedConnectionPool raises instead of waiting when exhausted,
+        # the semaphore makes callers block until a connection is returned
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._local = threading.local()
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
+            database=url.path[1:],
+            user=url.username,
+            password=url.password,
+            host=url.hostname,
+            port=url.port
+        )
+
+    def in_transaction(self):
+        return getattr(self._local, "connection", None) is not None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block inside a transaction. Nested scopes join the
+        outermost one, which is the only one that commits.
+        """
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._checkout()
+        self._local.connection = conn
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        except:
+            try:
+                conn.rollback()
+            except CONNECTION_ERRORS:
+                broken = True
+            raise
+        finally:
+            self._local.connection = None
+            self._release(conn, broken)
+
+    def close(self):
+        self._pool.closeall()
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            while True:
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self.logger.warn("Discarding broken database connection")
+                self._discard(conn)
+        except:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.time()
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        # only ping connections that sat idle long enough to have been dropped
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.time() - last_used < self.check_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+        except CONNECTION_ERRORS:
+            return False
+
+        self._last_used[id(conn)] = time.time()
+        return True
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import deque
+
+import logger
+from config import *
+from statefile import load_json
+from statefile import save_json
+
+class SlidingWindowLimiter(object):
+    """
+    Allows each key at most limit hits within any window of seconds, per
+    command, as configured in RATE_LIMITS. The state lives in memory and
+    can be saved to a file to survive restarts. Keys whose hits have all
+    expired are pruned as new hits come in.
+    """
+
+    def __init__(self, limits=RATE_LIMITS, path=RATE_LIMIT_STATE_FILE, save_period=RATE_LIMIT_SAVE_PERIOD):
+        self.limits = limits
+        self.path = path
+        self.save_period = save_period
+        self.hits = {}
+        self.logger = logger.get_logger(__name__)
+        self._lock = threading.Lock()
+        self._hits_since_prune = 0
+        self._last_save = time.time()
+        self.load()
+
+    def hit(self, command, key, now, token=None):
+        """
+        Records a hit at the now timestamp and returns whether it is within
+        the limits. A hit with the same token as an earlier one is a replay
+        of it and is always allowed.
+        """
+        limit, window = self.limits[command]
+        with self._lock:
+            hits = self.hits.setdefault((command, key), deque())
+            while hits and now - hits[0][0] > window:
+                hits.popleft()
+
+            if token is not None and any(t == token for _, t in hits):
+                return True
+            if len(hits) >= limit:
+                return False
+
+            hits.append((now, token))
+            self._prune(now)
+
+        if self.path and time.time() - self._last_save > self.save_period:
+            self.save()
+        return True
+
+    def load(self):
+        state = load_json(self.path, self.logger)
+        if state is None:
+            return
+
+        for command, key, hits in state:
+            self.hits[(command, tuple(key))] = deque((h[0], h[1]) for h in hits)
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            state = [[command, list(key), list(hits)] for (command, key), hits in self.hits.items() if hits]
+            self._last_save = time.time()
+
+        save_json(self.path, state)
+
+    def _prune(self, now):
+        self._hits_since_prune += 1
+        if self._hits_since_prune < RATE_LIMIT_PRUNE_EVERY:
+            return
+
+        self._hits_since_prune = 0
+        for (command, key), hits in list(self.hits.items()):
+            if not hits or now - hits[-1][0] > self.limits[command][1]:
+                del self.hits[(command, key)]
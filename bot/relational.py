@@ -0,0 +1,368 @@
+import threading
+
+from chat import Chat
+from tag import Tag
+from user import User
+from mapper import CREATE_MEMBERSHIPS
+from mapper import PostgreSQLMapper
+from mapper import db_operation
+from mapper import mapper_operation
+from config import *
+
+LEGACY_CHATS = CHATS_COLLECTION_NAME + "_blob"
+LEGACY_USERS = USERS_COLLECTION_NAME + "_blob"
+
+TABLES = {
+    "chats": CHATS_COLLECTION_NAME,
+    "users": USERS_COLLECTION_NAME,
+    "tags": TAGS_COLLECTION_NAME,
+}
+
+CREATE_SCHEMA = [s.format(**TABLES) for s in [
+    "CREATE TABLE IF NOT EXISTS {chats} (id varchar(20) PRIMARY KEY, name text, admin varchar(20));",
+    "CREATE TABLE IF NOT EXISTS {users} (id varchar(20) PRIMARY KEY, first_name text, last_name text, username text, last_tldr text);",
+    "CREATE TABLE IF NOT EXISTS {tags} (id serial PRIMARY KEY, chat_id varchar(20) NOT NULL, user_id varchar(20) NOT NULL, text text NOT NULL, date integer NOT NULL);",
+    "CREATE INDEX IF NOT EXISTS {tags}_chat_id_date ON {tags} (chat_id, date);",
+    "CREATE INDEX IF NOT EXISTS {tags}_user_id_date ON {tags} (user_id, date);",
+    "ALTER TABLE {chats} ADD COLUMN IF NOT EXISTS max_tags integer;",
+    # holds whatever followed /tldr, tables created before were too narrow for it
+    "ALTER TABLE {users} ALTER COLUMN last_tldr TYPE text;",
+]] + [CREATE_MEMBERSHIPS]
+
+SELECT_CHAT = "SELECT id, name, admin, max_tags FROM {chats} WHERE id=%(id)s;".format(**TABLES)
+INSERT_CHAT_IF_MISSING = "INSERT INTO {chats} (id) VALUES (%(id)s) ON CONFLICT (id) DO NOTHING;".format(**TABLES)
+LOCK_CHAT = "SELECT id FROM {chats} WHERE id=%(id)s FOR UPDATE;".format(**TABLES)
+UPSERT_CHAT = """
+INSERT INTO {chats} (id, name, admin, max_tags) VALUES (%(id)s, %(name)s, %(admin)s, %(max_tags)s)
+ON CONFLICT (id) DO UPDATE SET name=EXCLUDED.name, admin=EXCLUDED.admin, max_tags=EXCLUDED.max_tags;
+""".format(**TABLES)
+UPSERT_MAX_TAGS = """
+INSERT INTO {chats} (id, max_tags) VALUES (%(id)s, %(max_tags)s)
+ON CONFLICT (id) DO UPDATE SET max_tags=EXCLUDED.max_tags;
+""".format(**TABLES)
+
+# chats and their tags in one round trip, missing chats come back as a row of nulls
+SELECT_CHATS = """
+SELECT q.id, c.id, c.name, c.admin, c.max_tags, t.id, t.text, t.date, u.id, u.first_name, u.last_name, u.username
+FROM unnest(%(ids)s::varchar[]) AS q(id)
+LEFT JOIN {chats} c ON c.id = q.id
+LEFT JOIN {tags} t ON t.chat_id = q.id
+LEFT JOIN {users} u ON u.id = t.user_id
+ORDER BY q.id, t.date, t.id;
+""".format(**TABLES)
+SELECT_MAX_TAGS = "SELECT max_tags FROM {chats} WHERE id=%(id)s;".format(**TABLES)
+
+SELECT_USER = "SELECT id, first_name, last_name, username, last_tldr FROM {users} WHERE id=%(id)s;".format(**TABLES)
+UPSERT_USER = """
+INSERT INTO {users} (id, first_name, last_name, username, last_tldr)
+VALUES (%(id)s, %(first_name)s, %(last_name)s, %(username)s, %(last_tldr)s)
+ON CONFLICT (id) DO UPDATE SET first_name=EXCLUDED.first_name, last_name=EXCLUDED.last_name,
+    username=EXCLUDED.username, last_tldr=EXCLUDED.last_tldr;
+""".format(**TABLES)
+# legacy users must not clobber what was written since the migration started
+MERGE_LEGACY_USER = """
+INSERT INTO {users} (id, first_name, last_name, username, last_tldr)
+VALUES (%(id)s, %(first_name)s, %(last_name)s, %(username)s, %(last_tldr)s)
+ON CONFLICT (id) DO UPDATE SET last_tldr=COALESCE({users}.last_tldr, EXCLUDED.last_tldr);
+""".format(**TABLES)
+
+SELECT_TAGS = """
+SELECT t.id, t.text, t.date, u.id, u.first_name, u.last_name, u.username
+FROM {tags} t JOIN {users} u ON u.id = t.user_id
+WHERE t.chat_id=%(chat_id)s ORDER BY t.date, t.id;
+""".format(**TABLES)
+# the window count is taken before LIMIT, so every row carries the chat's total
+SELECT_TAGS_PAGE = """
+SELECT t.id, t.text, t.date, u.id, u.first_name, u.last_name, u.username, count(*) OVER ()
+FROM {tags} t JOIN {users} u ON u.id = t.user_id
+WHERE t.chat_id=%(chat_id)s ORDER BY t.date DESC, t.id DESC LIMIT %(limit)s OFFSET %(skip)s;
+""".format(**TABLES)
+COUNT_TAGS = "SELECT count(*) FROM {tags} WHERE chat_id=%(chat_id)s;".format(**TABLES)
+DELETE_TAG = "DELETE FROM {tags} WHERE id=%(id)s AND chat_id=%(chat_id)s;".format(**TABLES)
+DELETE_TAGS_NOT_IN = "DELETE FROM {tags} WHERE chat_id=%(chat_id)s AND id <> ALL(%(ids)s::integer[]);".format(**TABLES)
+
+# the tag's author is upserted in the same statement so a tag is one round trip
+UPSERT_AUTHOR = """
+author AS (
+    INSERT INTO {users} (id, first_name, last_name, username)
+    VALUES (%(user_id)s, %(first_name)s, %(last_name)s, %(username)s)
+    ON CONFLICT (id) DO UPDATE SET first_name=EXCLUDED.first_name,
+        last_name=EXCLUDED.last_name, username=EXCLUDED.username
+)
+""".format(**TABLES)
+TRIM_TAGS = """
+evicted AS (
+    DELETE FROM {tags} WHERE id IN (
+        -- one less than the retention, the new tag takes the last place
+        SELECT id FROM {tags} WHERE chat_id=%(chat_id)s ORDER BY date DESC, id DESC
+        OFFSET COALESCE((SELECT max_tags FROM {chats} WHERE id=%(chat_id)s), %(max_tags)s) - 1
+    )
+)
+""".format(**TABLES)
+TRIM_TAGS_TO = """
+DELETE FROM {tags} WHERE id IN (
+    SELECT id FROM {tags} WHERE chat_id=%(chat_id)s ORDER BY date DESC, id DESC OFFSET %(max_tags)s
+);
+""".format(**TABLES)
+INSERT_TAG_VALUES = """
+INSERT INTO {tags} (chat_id, user_id, text, date)
+VALUES (%(chat_id)s, %(user_id)s, %(text)s, %(date)s) RETURNING id;
+""".format(**TABLES)
+INSERT_TAG = "WITH " + UPSERT_AUTHOR + INSERT_TAG_VALUES
+INSERT_TAG_AND_TRIM = "WITH " + UPSERT_AUTHOR + ", " + TRIM_TAGS + INSERT_TAG_VALUES
+
+SELECT_BLOB_TABLE = """
+SELECT 1 FROM information_schema.columns WHERE table_name=%(table)s AND column_name='value';
+"""
+SELECT_TABLE_EXISTS = "SELECT to_regclass(%(table)s) IS NOT NULL;"
+RENAME_TABLE = "ALTER TABLE {} RENAME TO {};"
+# each worker claims a different legacy row, so several processes can migrate at once
+CLAIM_LEGACY_ROW = "DELETE FROM {0} WHERE id = (SELECT id FROM {0} LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING id, value;"
+TAKE_LEGACY_ROW = "DELETE FROM {} WHERE id=%(id)s RETURNING id, value;"
+
+class RelationalMapper(PostgreSQLMapper):
+    """
+    Stores chats, users and tags in their own tables so tags can be added,
+    read and deleted individually instead of rewriting a whole chat blob.
+
+    Tables from the blob-per-row PostgreSQLMapper are renamed to *_blob on
+    startup and migrated in the background. Until that finishes, any chat or
+    user that is accessed is migrated on the spot.
+    """
+
+    row_tags = True
+
+    @mapper_operation
+    def provision_db(self):
+        with self.transaction():
+            for table, legacy in [(CHATS_COLLECTION_NAME, LEGACY_CHATS), (USERS_COLLECTION_NAME, LEGACY_USERS)]:
+                if self._fetchone(SELECT_BLOB_TABLE, {'table': table}):
+                    self._execute(RENAME_TABLE.format(table, legacy))
+
+            for statement in CREATE_SCHEMA:
+                self._execute(statement)
+
+        self.legacy_tables = set(t for t in [LEGACY_CHATS, LEGACY_USERS]
+                                 if self._fetchone(SELECT_TABLE_EXISTS, {'table': t})[0])
+        if self.legacy_tables:
+            thread = threading.Thread(target=self.migrate_legacy_blobs)
+            thread.daemon = True
+            thread.start()
+
+    @mapper_operation
+    def get_chat_by_id(self, id):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, id)
+            row = self._fetchone(SELECT_CHAT, {'id': id})
+            tags = [self._tag_from_row(r) for r in self._fetchall(SELECT_TAGS, {'chat_id': id})]
+
+        if not row and not tags:
+            return None
+
+        chat = Chat(id, tags=tags)
+        if row:
+            chat.name = row[1] or ""
+            chat.admin = row[2]
+            chat.max_tags = row[3]
+        return chat
+
+    @mapper_operation
+    def get_chats(self, chat_ids):
+        with self.transaction():
+            for id in chat_ids:
+                self._migrate_legacy_row(LEGACY_CHATS, id)
+            rows = self._fetchall(SELECT_CHATS, {'ids': list(chat_ids)})
+
+        chats = {}
+        for row in rows:
+            if row[1] is None and row[5] is None:
+                continue
+
+            chat = chats.get(row[0])
+            if chat is None:
+                chat = chats[row[0]] = Chat(row[0], name=row[2] or "", admin=row[3], max_tags=row[4])
+            if row[5] is not None:
+                chat.tags.append(self._tag_from_row(row[5:]))
+        return chats
+
+    @mapper_operation
+    def save_chat(self, chat):
+        with self.transaction():
+            self._execute(UPSERT_CHAT, self._chat_values(chat))
+
+            ids = [t.id for t in chat.tags if t.id is not None]
+            self._execute(DELETE_TAGS_NOT_IN, {'chat_id': chat.id, 'ids': ids})
+            for tag in chat.tags:
+                if tag.id is None:
+                    self._insert_tag(chat.id, tag)
+
+    @mapper_operation
+    def update_chat(self, chat_id, func):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, chat_id)
+            self._execute(INSERT_CHAT_IF_MISSING, {'id': chat_id})
+            self._fetchone(LOCK_CHAT, {'id': chat_id})
+
+            chat = self.get_chat_by_id(chat_id)
+            result = func(chat)
+            self.save_chat(chat)
+            return result
+
+    @mapper_operation
+    def get_user_by_id(self, id):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_USERS, id)
+            row = self._fetchone(SELECT_USER, {'id': id})
+
+        if not row:
+            return None
+
+        user = User(row[0], row[1] or "", row[2] or "", row[3] or "")
+        user.last_tldr = row[4]
+        return user
+
+    @mapper_operation
+    def save_user(self, user):
+        self._execute(UPSERT_USER, self._user_values(user))
+
+    @mapper_operation
+    def get_tags(self, chat_id):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, chat_id)
+            rows = self._fetchall(SELECT_TAGS, {'chat_id': chat_id})
+
+        return [self._tag_from_row(r) for r in rows]
+
+    @mapper_operation
+    def get_tags_page(self, chat_id, skip, limit):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, chat_id)
+            rows = self._fetchall(SELECT_TAGS_PAGE, {'chat_id': chat_id, 'skip': skip, 'limit': limit})
+            if rows:
+                total = rows[0][7]
+            else:
+                total = self._fetchone(COUNT_TAGS, {'chat_id': chat_id})[0]
+
+        return [self._tag_from_row(r) for r in reversed(rows)], total
+
+    @mapper_operation
+    def add_tag(self, chat_id, tag, max_tags=MAX_TAGS):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, chat_id)
+            self._insert_tag(chat_id, tag, max_tags=max_tags)
+
+    @mapper_operation
+    def get_retention(self, chat_id):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, chat_id)
+            row = self._fetchone(SELECT_MAX_TAGS, {'id': chat_id})
+
+        return row[0] if row and row[0] else MAX_TAGS
+
+    @mapper_operation
+    def set_max_tags(self, chat_id, max_tags):
+        with self.transaction():
+            self._migrate_legacy_row(LEGACY_CHATS, chat_id)
+            self._execute(UPSERT_MAX_TAGS, {'id': chat_id, 'max_tags': max_tags})
+            self._execute(TRIM_TAGS_TO, {'chat_id': chat_id, 'max_tags': max_tags})
+
+    @mapper_operation
+    def delete_tag(self, chat_id, tag):
+        self._execute(DELETE_TAG, {'id': tag.id, 'chat_id': chat_id})
+
+    @mapper_operation
+    def migrate_legacy_blobs(self):
+        """
+        Moves every row left in the legacy blob tables into the relational
+        tables, one short transaction per row
+        """
+        migrated = 0
+        try:
+            for table in sorted(self.legacy_tables):
+                while self._migrate_next_legacy_row(table):
+                    migrated += 1
+                self.legacy_tables.discard(table)
+                self.logger.info("Finished migrating %s, it can be dropped" % table)
+        except Exception as e:
+            self.logger.error("Legacy blob migration stopped: %s" % e)
+
+        self.logger.info("Migrated %s legacy rows" % migrated)
+
+    def _migrate_next_legacy_row(self, table):
+        with self.transaction():
+            row = self._fetchone(CLAIM_LEGACY_ROW.format(table))
+            if not row:
+                return False
+
+            self._import_legacy(table, self.codec.decode(row[1]))
+            return True
+
+    def _migrate_legacy_row(self, table, id):
+        if table not in self.legacy_tables:
+            return
+
+        row = self._fetchone(TAKE_LEGACY_ROW.format(table), {'id': id})
+        if row:
+            self._import_legacy(table, self.codec.decode(row[1]))
+
+    def _import_legacy(self, table, obj):
+        if table == LEGACY_USERS:
+            self._execute(MERGE_LEGACY_USER, self._user_values(obj))
+            return
+
+        # tags added since the migration started are kept alongside the old ones
+        self._execute(UPSERT_CHAT, self._chat_values(obj))
+        for tag in obj.tags:
+            self._insert_tag(obj.id, tag)
+
+    def _insert_tag(self, chat_id, tag, max_tags=None):
+        values = {
+            'chat_id': chat_id,
+            'user_id': tag.user.id,
+            'first_name': tag.user.first_name,
+            'last_name': tag.user.last_name,
+            'username': tag.user.username,
+            'text': tag.text,
+            'date': tag.date,
+        }
+        statement = INSERT_TAG
+        if max_tags is not None:
+            statement = INSERT_TAG_AND_TRIM
+            values['max_tags'] = max_tags
+
+        tag.id = self._fetchone(statement, values)[0]
+
+    def _tag_from_row(self, row):
+        user = User(row[3], row[4] or "", row[5] or "", row[6] or "")
+        return Tag(text=row[1], user=user, date=row[2], id=row[0])
+
+    def _chat_values(self, chat):
+        return {
+            'id': chat.id,
+            'name': chat.name,
+            'admin': chat.admin,
+            'max_tags': getattr(chat, "max_tags", None),
+        }
+
+    def _user_values(self, user):
+        return {
+            'id': user.id,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'username': user.username,
+            'last_tldr': getattr(user, "last_tldr", None),
+        }
+
+    @db_operation
+    def _execute(self, cursor, statement, values=None):
+        cursor.execute(statement, values)
+
+    @db_operation
+    def _fetchone(self, cursor, statement, values=None):
+        cursor.execute(statement, values)
+        return cursor.fetchone()
+
+    @db_operation
+    def _fetchall(self, cursor, statement, values=None):
+        cursor.execute(statement, values)
+        return cursor.fetchall()
@@ -0,0 +1,88 @@
+from cache import LRUCache
+from cache import MISSING
+from config import *
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """
+    Splits text into parts that fit in a message, between lines unless a
+    single line is too long
+    """
+    parts = []
+    current = ""
+    for line in text.split("\n"):
+        candidate = current + "\n" + line if current else line
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+
+        if current:
+            parts.append(current)
+        while len(line) > limit:
+            parts.append(line[:limit])
+            line = line[limit:]
+        current = line
+
+    if current:
+        parts.append(current)
+    return parts
+
+class TldrRenderer(object):
+    """
+    Renders /tldr responses one page at a time, page 1 holding the most
+    recent tags. The pages of each chat are cached per timezone until
+    invalidate() is called for the chat, and the line of each tag is
+    cached for as long as the tag exists, so only changed tags are
+    formatted again.
+    """
+
+    def __init__(self, timezone=LOCAL_TIMEZONE, size=RENDER_CACHE_SIZE, ttl=RENDER_CACHE_TTL,
+                 page_size=TLDR_PAGE_SIZE):
+        self.timezone = timezone
+        self.page_size = page_size
+        self.responses = LRUCache(size, ttl)
+        self.lines = LRUCache(size * page_size, ttl)
+
+    def render(self, chat_id, load_page, page=1):
+        """
+        Returns the text of a /tldr page of the chat and how many tags the
+        chat has. load_page(skip, limit) is only called to get the page's
+        tags and the chat's total when the text is not cached.
+        """
+        responses = self.responses.get(chat_id)
+        if responses is MISSING:
+            responses = {}
+            self.responses.put(chat_id, responses)
+
+        key = (self.timezone.zone, page)
+        response = responses.get(key)
+        if response is None:
+            tags, total = load_page((page - 1) * self.page_size, self.page_size)
+            response = responses[key] = (self.render_tags(chat_id, tags, total, page), total)
+        return response
+
+    def render_tags(self, chat_id, tags, total, page=1):
+        if not total:
+            return "No Tags found for this chat"
+
+        pages = (total + self.page_size - 1) // self.page_size
+        if not tags:
+            return "Chat %s only has %s page%s of tags" % (chat_id, pages, "" if pages == 1 else "s")
+
+        # numbered by position in the whole chat, as /deletetag expects
+        first = total - (page - 1) * self.page_size - len(tags) + 1
+        lines = ["%s. %s" % (first + i, self.render_tag(t)) for i, t in enumerate(tags)]
+        text = "Tags for chat %s:\n%s" % (chat_id, "\n".join(lines))
+        if page < pages:
+            text += "\n\nPage %s of %s, '/tldr %s page %s' for older tags" % (page, pages, chat_id, page + 1)
+        return text
+
+    def render_tag(self, tag):
+        key = (tag.key(), self.timezone.zone)
+        line = self.lines.get(key)
+        if line is MISSING:
+            line = tag.pretty_print(self.timezone)
+            self.lines.put(key, line)
+        return line
+
+    def invalidate(self, chat_id):
+        self.responses.invalidate(chat_id)
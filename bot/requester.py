@@ -1,63 +1,114 @@
-import requests
 import json
+import threading
+import time
+
+import requests
+import requests.adapters
 
 import logger
+import metrics
 from config import *
 
 # Credits to @ixai for this Requester model
 
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Returns the session shared by every request. Its connection pool is
+    thread-safe, so requests from any thread reuse the open connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+def reset_session():
+    """
+    Drops the shared session, e.g. in a forked process whose inherited
+    connections belong to the parent
+    """
+    global _session
+    with _session_lock:
+        _session = None
+
 class Encoder(json.JSONEncoder):
     def default(self, o):
         return {k:o.__dict__[k] for k in o.__dict__ if o.__dict__[k] != None}
 
 class Requester(object):
-    def __init__(self, url, request_path, query_params, request_body=None):
+    # requests that can be repeated safely are retried on network errors
+    idempotent = False
+
+    def __init__(self, url, request_path, query_params, request_body=None, session=None, timeout=None):
         self.__url = "%s%s" % (url, request_path)
+        self.__api_method = request_path.lstrip("/")
         self.__query_params = query_params
         self.__request_body = request_body
+        self.__http = session or get_session()
+        self.__timeout = timeout if timeout is not None else HTTP_TIMEOUT
         self.logger = logger.get_logger(__name__)
 
-    def __query(self):
-        r = reduce(lambda x,y: "%s%s=%s&" % (x,y,self.__query_params[y]), self.__query_params, "")
-        return r
+    def __send(self, method, **kwargs):
+        attempts = 1 + (HTTP_RETRIES if self.idempotent else 0)
+        with metrics.API_SECONDS.time(method=self.__api_method):
+            for attempt in range(attempts):
+                try:
+                    return getattr(self.__http, method)(self.__url, params=self.__query_params,
+                                                        timeout=self.__timeout, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt == attempts - 1:
+                        metrics.API_ERRORS.inc(method=self.__api_method)
+                        raise
+                    self.logger.warn("%s %s failed, retrying: %s" % (method.upper(), self.__url, e))
+                    time.sleep(HTTP_RETRY_BACKOFF * 2 ** attempt)
 
     def _post(self):
         data = json.dumps(self.__request_body, cls=Encoder)
-        self.logger.info("POST %s?%s\n%s" % (self.__url, self.__query(), data))
-        r = requests.post(self.__url, params=self.__query_params, data=data)
+        self.logger.debug("POST %s %s\n%s", self.__url, logger.Truncated(self.__query_params),
+                          logger.Truncated(data))
+        r = self.__send("post", data=data)
         b = r.text
         if b == "":
             b = "{}"
-        self.logger.info("Response: %s" % (b))
+        self.logger.debug("Response: %s", logger.Truncated(b))
         return (r, json.loads(b))
 
     def _get(self):
-        self.logger.info("GET %s?%s" % (self.__url, self.__query()))
-        r = requests.get(self.__url, params=self.__query_params)
+        self.logger.debug("GET %s %s", self.__url, logger.Truncated(self.__query_params))
+        r = self.__send("get")
         b = r.text
         if b == "":
             b = "{}"
-        self.logger.info("Response: %s" % (b))
+        self.logger.debug("Response: %s", logger.Truncated(b))
         return (r, json.loads(b))
 
     def _delete(self):
-        self.logger.info("DELETE %s?%s" % (self.__url, self.__query()))
-        r = requests.delete(self.__url, params=self.__query_params)
+        self.logger.debug("DELETE %s %s", self.__url, logger.Truncated(self.__query_params))
+        r = self.__send("delete")
         b = r.text
         if b == "":
             b = "{}"
-        self.logger.info("Response: %s" % (b))
+        self.logger.debug("Response: %s", logger.Truncated(b))
         return (r, json.loads(b))
 
 class TlDrRequester(Requester):
 
-    def __init__(self, request_path, query_params, request_body=None):
-        super(TlDrRequester, self).__init__(BOT_URL, request_path, query_params, request_body)
+    def __init__(self, request_path, query_params, request_body=None, session=None, timeout=None):
+        super(TlDrRequester, self).__init__(BOT_URL, request_path, query_params, request_body, session, timeout)
 
 class SetWebhookRequest(TlDrRequester):
     """
     POST /setWebhook
     """
+    idempotent = True
+
     def __init__(self, url=""):
         request_path = '/setWebhook'
         request_body = {}
@@ -73,7 +124,9 @@ class GetUpdatesRequest(TlDrRequester):
     """
     GET /getUpdates
     """
-    def __init__(self, offset=0, limit=100, timeout=0):
+    idempotent = True
+
+    def __init__(self, offset=0, limit=100, timeout=0, session=None):
         request_path = '/getUpdates'
         request_body = {}
         query_params = {
@@ -81,7 +134,27 @@ class GetUpdatesRequest(TlDrRequester):
             "limit": limit,
             "timeout": timeout
         }
-        super(GetUpdatesRequest, self).__init__(request_path, query_params, request_body)
+        # with long polling Telegram holds the request open for up to timeout seconds
+        http_timeout = timeout + LONG_POLL_GRACE
+        super(GetUpdatesRequest, self).__init__(request_path, query_params, request_body, session, http_timeout)
+
+    def do(self):
+        return self._get()
+
+class GetChatMemberRequest(TlDrRequester):
+    """
+    GET /getChatMember
+    """
+    idempotent = True
+
+    def __init__(self, chat_id, user_id):
+        request_path = '/getChatMember'
+        request_body = {}
+        query_params = {
+            "chat_id": chat_id,
+            "user_id": user_id
+        }
+        super(GetChatMemberRequest, self).__init__(request_path, query_params, request_body)
 
     def do(self):
         return self._get()
@@ -90,15 +163,16 @@ class SendMessageRequest(TlDrRequester):
     """
     GET /sendMessage
     """
-    def __init__(self, chat_id, text, extra_query_params={}):
+    def __init__(self, chat_id, text, extra_query_params=None):
         request_path = '/sendMessage'
         request_body = {}
-        query_params = {
+        # a new dict per request, outbox workers build requests concurrently
+        query_params = dict(extra_query_params or {})
+        query_params.update({
             "chat_id": chat_id,
             "text": text
-        }
-        extra_query_params.update(query_params)
-        super(SendMessageRequest, self).__init__(request_path, extra_query_params, request_body)
+        })
+        super(SendMessageRequest, self).__init__(request_path, query_params, request_body)
 
     def do(self):
         return self._get()
@@ -0,0 +1,123 @@
+import bisect
+import re
+import threading
+from collections import OrderedDict
+
+from cache import LRUCache
+from cache import MISSING
+from config import *
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+class ChatIndex(object):
+    """
+    Inverted index of the tags of one chat, from each token of their text
+    to the tags that have it. Keeps the chat's retention: adding past it
+    drops the oldest tags, as the storage does.
+    """
+
+    def __init__(self, retention):
+        self.retention = retention
+        self.tags = OrderedDict() # tag key -> tag, oldest first
+        self.postings = {}
+        self.tokens = [] # sorted, for prefix lookups
+
+    def add(self, tag):
+        key = tag.key()
+        if key in self.tags:
+            return
+
+        self.tags[key] = tag
+        for token in set(tokenize(tag.text)):
+            if token not in self.postings:
+                self.postings[token] = set()
+                bisect.insort(self.tokens, token)
+            self.postings[token].add(key)
+
+        while len(self.tags) > self.retention:
+            self.remove(next(iter(self.tags)))
+
+    def remove(self, key):
+        tag = self.tags.pop(key, None)
+        if tag is None:
+            return
+
+        for token in set(tokenize(tag.text)):
+            keys = self.postings[token]
+            keys.discard(key)
+            if not keys:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def search(self, terms, limit):
+        """
+        Returns the (number, tag) of the most recent tags, newest first,
+        that have a token starting with each of the terms. Numbers are the
+        tags' positions in the chat, as shown by /tldr.
+        """
+        matches = None
+        for term in terms:
+            keys = set()
+            i = bisect.bisect_left(self.tokens, term)
+            while i < len(self.tokens) and self.tokens[i].startswith(term):
+                keys.update(self.postings[self.tokens[i]])
+                i += 1
+
+            matches = keys if matches is None else matches & keys
+            if not matches:
+                return []
+
+        positions = dict((key, i + 1) for i, key in enumerate(self.tags))
+        found = sorted(matches, key=lambda key: (self.tags[key].date, positions[key]), reverse=True)
+        return [(positions[key], self.tags[key]) for key in found[:limit]]
+
+class TagIndex(object):
+    """
+    Search index of the tags of the most recently searched chats. A chat
+    is indexed from storage the first time it is searched, then kept up to
+    date with add() and remove() as tags change. Chats are rebuilt after
+    ttl seconds, which also picks up changes made by other processes.
+    """
+
+    def __init__(self, size=SEARCH_INDEX_SIZE, ttl=SEARCH_INDEX_TTL):
+        self.chats = LRUCache(size, ttl)
+        self._lock = threading.Lock()
+
+    def search(self, chat_id, text, load_chat, limit=SEARCH_RESULTS):
+        """
+        Finds the tags of the chat matching every term of text.
+        load_chat() returns the chat's tags and retention, it is only
+        called when the chat is not indexed.
+        """
+        terms = tokenize(text)
+        if not terms:
+            return []
+
+        index = self.chats.get(chat_id)
+        if index is MISSING:
+            tags, retention = load_chat()
+            index = ChatIndex(retention)
+            for tag in tags:
+                index.add(tag)
+            self.chats.put(chat_id, index)
+
+        with self._lock:
+            return index.search(terms, limit)
+
+    def add(self, chat_id, tag):
+        index = self.chats.peek(chat_id)
+        if index is not MISSING:
+            with self._lock:
+                index.add(tag)
+
+    def remove(self, chat_id, tag):
+        index = self.chats.peek(chat_id)
+        if index is not MISSING:
+            with self._lock:
+                index.remove(tag.key())
+
+    def invalidate(self, chat_id):
+        self.chats.invalidate(chat_id)
@@ -0,0 +1,32 @@
+import json
+import os
+
+def write_atomically(path, data):
+    """
+    Replaces the file's content with data. It is written aside, synced to
+    disk and renamed, so a crash leaves either the old or the new content.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def load_json(path, logger):
+    """
+    Returns the value saved with save_json, None if the file doesn't exist
+    or can't be read, which is logged
+    """
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError as e:
+        logger.error("Ignoring unreadable state %s: %s" % (path, e))
+        return None
+
+def save_json(path, value):
+    write_atomically(path, json.dumps(value))
@@ -4,12 +4,19 @@ from config import *
 
 class Tag(object):
 
-    def __init__(self, text, user, date):
+    def __init__(self, text, user, date, id=None):
         self.text = text
         self.user = user
         self.date  = date
+        self.id = id
 
-    def pretty_print(self):
-        date = datetime.fromtimestamp(self.date, tz=LOCAL_TIMEZONE).strftime('%a %d %I:%M%p')
+    def key(self):
+        """
+        Identifies the tag within its chat, whatever the storage it came from
+        """
+        return (self.user.id, self.date, self.text)
+
+    def pretty_print(self, timezone=LOCAL_TIMEZONE):
+        date = datetime.fromtimestamp(self.date, tz=timezone).strftime('%a %d %I:%M%p')
         username = self.user.pretty_print()
         return '"%s" @%s %s' % (self.text, username, date)
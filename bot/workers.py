@@ -0,0 +1,131 @@
+import multiprocessing
+import Queue
+import threading
+import traceback
+import zlib
+
+import logger
+
+class Stop(object):
+    """
+    Tells a worker to exit, compared by type since it may be pickled
+    """
+
+class ShardedWorkerPool(object):
+    """
+    Runs handler over submitted items on a fixed set of workers, threads
+    or processes. Items with the same key always go to the same worker, so
+    they are handled one at a time and in submission order. Each worker
+    has a bounded queue; submitting to a full one blocks or raises
+    Queue.Full.
+
+    Process workers are forked. initializer(index) runs first in each of
+    them to replace whatever can't be shared with the parent, and
+    finalizer() when the worker stops.
+
+    With keep_failed, the items whose handler raised are kept until the
+    next join() returns them.
+    """
+
+    def __init__(self, handler, workers, queue_size=0, name="worker", processes=False,
+                 initializer=None, finalizer=None, keep_failed=False):
+        self.handler = handler
+        self.keep_failed = keep_failed
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self.stopped = False
+        self.logger = logger.get_logger(__name__)
+
+        if processes:
+            self.queues = [multiprocessing.JoinableQueue(queue_size) for _ in range(workers)]
+            self._failed = multiprocessing.Value("i", 0)
+            self._failures = multiprocessing.Queue()
+            worker_class = multiprocessing.Process
+        else:
+            self.queues = [Queue.Queue(queue_size) for _ in range(workers)]
+            self._failed = FailureCounter()
+            self._failures = Queue.Queue()
+            worker_class = threading.Thread
+
+        self.workers = []
+        for i, queue in enumerate(self.queues):
+            worker = worker_class(target=self._run, args=(i, queue), name="%s-%s" % (name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key, item, block=True, timeout=None):
+        if self.stopped:
+            raise WorkerPoolStoppedException("Pool is not accepting work")
+        self.queue_for(key).put(item, block, timeout)
+
+    def queue_for(self, key):
+        # crc32 instead of hash() so the same key maps to the same worker in every process
+        return self.queues[(zlib.crc32(str(key)) & 0xffffffff) % len(self.queues)]
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def join(self):
+        """
+        Waits until every item submitted so far has been handled and returns
+        the ones that failed since the last join, as the handler left them,
+        if the pool keeps them
+        """
+        for queue in self.queues:
+            queue.join()
+
+        with self._failed.get_lock():
+            failed = self._failed.value
+            self._failed.value = 0
+        if not self.keep_failed:
+            return []
+        # blocking, a process worker's item may still be on its way
+        return [self._failures.get() for _ in range(failed)]
+
+    def stop(self):
+        """
+        Stops accepting work and waits for the pending items to be handled
+        """
+        self.stopped = True
+        for queue in self.queues:
+            queue.put(Stop())
+        for worker in self.workers:
+            worker.join()
+
+    def _run(self, index, queue):
+        if self.initializer:
+            self.initializer(index)
+
+        while True:
+            item = queue.get()
+            try:
+                if isinstance(item, Stop):
+                    if self.finalizer:
+                        self.finalizer()
+                    return
+                self.handler(item)
+            except Exception as e:
+                self.logger.error(str(traceback.format_exc()))
+                self.logger.error(e)
+                if self.keep_failed:
+                    self._failures.put(item)
+                with self._failed.get_lock():
+                    self._failed.value += 1
+            finally:
+                queue.task_done()
+
+class FailureCounter(object):
+    """
+    Thread counterpart of multiprocessing.Value
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def get_lock(self):
+        return self._lock
+
+class WorkerPoolStoppedException(Exception):
+    pass